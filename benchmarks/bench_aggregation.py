@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of merging `winWeek` rows into per-hero stats, comparing the previous quadratic merge with
+HeroStatsTable as the number of weeks grows.
+
+Run from the repository root:
+
+    python benchmarks/bench_aggregation.py
+"""
+
+from pathlib import Path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dota_hero_grid_generator import HeroStatsTable
+
+
+HERO_COUNT = 124
+
+
+def generate_rows(weeks, positions):
+    rng = random.Random(weeks * 10 + positions)
+    rows = []
+    for _ in range(weeks * positions):
+        for hero_id in range(1, HERO_COUNT + 1):
+            match_count = rng.randint(100, 5000)
+            rows.append({
+                'heroId': hero_id,
+                'matchCount': match_count,
+                'winCount': int(match_count * rng.uniform(0.4, 0.6))
+            })
+
+    return rows
+
+
+def quadratic_merge(heroes_raw):
+    heroes_raw = [dict(hero) for hero in heroes_raw]
+    heroes = []
+    for hero in heroes_raw:
+        if any([hero['heroId'] == h['heroId'] for h in heroes]):
+            continue
+
+        for h in [h for h in heroes_raw if hero['heroId'] == h['heroId']][1:]:
+            hero['winCount'] += h['winCount']
+            hero['matchCount'] += h['matchCount']
+
+        heroes.append(hero)
+
+    all_match_count = sum([hero['matchCount'] for hero in heroes])
+
+    for hero in heroes:
+        hero['pickRate'] = round(hero['matchCount'] / (all_match_count / 10) * 100, 2)
+        hero['winRate'] = round(hero['winCount'] / hero['matchCount'] * 100, 2)
+
+    return heroes
+
+
+def main():
+    print('{:>6} {:>10} {:>8} {:>14} {:>14} {:>9}'.format('weeks', 'positions', 'rows', 'quadratic (ms)', 'table (ms)', 'speedup'))
+    for weeks in (1, 4, 12, 26, 52):
+        for positions in (1, 2):
+            rows = generate_rows(weeks, positions)
+            number = 3
+            quadratic = min(timeit.repeat(lambda: quadratic_merge(rows), number=number, repeat=3)) / number
+            table = min(timeit.repeat(lambda: HeroStatsTable(rows).sorted('win_rate'), number=number, repeat=3)) / number
+            print('{:>6} {:>10} {:>8} {:>14.2f} {:>14.2f} {:>8.1f}x'.format(weeks, positions, len(rows), quadratic * 1000, table * 1000, quadratic / table))
+
+
+if __name__ == '__main__':
+    main()
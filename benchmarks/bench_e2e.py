@@ -0,0 +1,201 @@
+"""
+End-to-end benchmark of grid generation against a local stand-in for Stratz (see fake_stratz.py).
+
+Every scenario builds a synthetic Steam directory with `loginusers.vdf` and userdata folders for its users, runs a full
+generation pass into it, and reports wall time, the number of requests Stratz received, the time spent waiting on the
+rate limiter, and peak memory (of the whole process, fake Stratz included). No Stratz token or quota is needed.
+
+Run from the repository root:
+
+    python benchmarks/bench_e2e.py
+    python benchmarks/bench_e2e.py --latency 0.2 --requests-per-second 3
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import aiohttp
+from aiohttp import web
+import vdf
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dota_hero_grid_generator import DOTA2_APP_ID, HeroGridCategory, HeroGridsConfig, StratzCache, StratzClient, generate, layout_category
+from fake_stratz import FakeStratz
+
+
+RANK_SETS = [
+    ['Herald', 'Guardian'],
+    ['Crusader', 'Archon', 'Legend'],
+    ['Archon', 'Legend'],
+    ['Ancient', 'Divine'],
+    ['Divine', 'Immortal']
+]
+
+POSITION_SETS = [[1], [2], [3], [4], [5], [4, 5], [1, 2], [2, 3], [1, 3]]
+
+SCENARIOS = [
+    # name, grids, categories per grid, weeks, users, extra stratz config, extra grid config
+    ('baseline', 1, 5, 4, 1, {}, {}),
+    ('10 grids', 10, 5, 4, 1, {}, {}),
+    ('50 grids', 50, 5, 4, 1, {}, {}),
+    ('20 categories', 1, 20, 4, 1, {}, {}),
+    ('12 weeks', 1, 5, 12, 1, {}, {}),
+    ('10 users', 10, 5, 4, 10, {}, {}),
+    ('10 grids, batched', 10, 5, 4, 1, {'batch_size': 10}, {}),
+    ('10 grids, split', 10, 5, 4, 1, {'split_positions': True, 'split_ranks': True}, {}),
+    ('20 variants', 1, 5, 4, 1, {}, {'variants': {'winrate_treshold': [48, 49, 50, 51, 52], 'pickrate_treshold': [1, 2], 'sort_by': ['win_rate', 'pick_rate']}})
+]
+
+
+class FakeStratzServer:
+    """
+    Runs FakeStratz in a thread with its own event loop, so that it doesn't compete with the generator for the loop.
+    """
+
+    def __init__(self, fake_stratz):
+        self.fake_stratz = fake_stratz
+        self.ready = threading.Event()
+        self.stopped = None
+        self.url = None
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        self.stopped = loop.create_future()
+
+        async def serve():
+            runner = web.AppRunner(self.fake_stratz.create_app())
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.url = f'http://127.0.0.1:{port}/graphql'
+            self.ready.set()
+            await self.stopped
+            await runner.cleanup()
+
+        self.loop = loop
+        loop.run_until_complete(serve())
+        loop.close()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.loop.call_soon_threadsafe(self.stopped.set_result, None)
+        self.thread.join()
+
+
+def create_steam_tree(root, user_count):
+    users = {}
+    for i in range(user_count):
+        id64 = 76561198000000000 + i
+        users[str(id64)] = {'AccountName': f'account{i}', 'PersonaName': f'Player {i}'}
+        (Path(root) / HeroGridsConfig.STEAM_USERDATA_FOLDER_NAME / str(id64 - 76561197960265728) / str(DOTA2_APP_ID) /
+            HeroGridsConfig.STEAM_USERDATA_REMOTE_FOLDER_NAME / HeroGridsConfig.DOTA2_CFG_FOLDER_NAME).mkdir(parents=True)
+
+    (Path(root) / 'config').mkdir()
+    with open(Path(root) / 'config' / 'loginusers.vdf', 'w', encoding='utf-8') as fp:
+        vdf.dump({'users': users}, fp, pretty=True)
+
+    return [user['AccountName'] for user in users.values()]
+
+
+def create_config(api_url, requests_per_second, steam_path, grid_count, category_count, weeks, users, stratz_config, grid_config={}):
+    grids = []
+    for i in range(grid_count):
+        grids.append(dict({
+            'name': f'Grid {i}',
+            'users': users,
+            'ranks': RANK_SETS[i % len(RANK_SETS)],
+            'modes': ['ALL_PICK_RANKED'],
+            'winrate_treshold': 48 + i % 4,
+            'pickrate_treshold': 1 + i % 3,
+            'show_pickrates': i % 2 == 0,
+            'include_outliers': True,
+            'show_outliers_separately': True,
+            'winrate_outlier_treshold': 53,
+            'pickrate_outlier_treshold': 10,
+            'weeks': weeks,
+            'categories': [{'positions': POSITION_SETS[j % len(POSITION_SETS)]} for j in range(category_count)]
+        }, **grid_config))
+
+    return {
+        'stratz': dict({'token': 'benchmark', 'requests_per_second': requests_per_second, 'api_url': api_url}, **stratz_config),
+        'steam': {'path': steam_path},
+        'grids': grids
+    }
+
+
+async def run_scenario(config, cache_path):
+    async with aiohttp.ClientSession() as http_session:
+        stratz_client = StratzClient(
+            config['stratz']['token'],
+            config['stratz']['requests_per_second'],
+            http_session,
+            config['stratz']['api_url']
+        )
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            await generate(config, stratz_client, StratzCache(cache_path, 0, 100))
+
+    return stratz_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks grid generation against a local stand-in for Stratz.')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake Stratz takes to respond (default: 0.05)')
+    parser.add_argument('--requests-per-second', type=int, default=10, help='requests_per_second in the generated configs (default: 10)')
+    parser.add_argument('--scenario', action='append', help='only run scenarios with this name (can be repeated)')
+    args = parser.parse_args()
+
+    print('{:<22} {:>9} {:>9} {:>13} {:>13}'.format('scenario', 'wall (s)', 'requests', 'limiter (s)', 'peak (MiB)'))
+    for name, grid_count, category_count, weeks, user_count, stratz_config, grid_config in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+
+        HeroGridCategory.built.clear()
+        layout_category.cache_clear()
+
+        fake_stratz = FakeStratz(args.latency)
+        with FakeStratzServer(fake_stratz) as server, tempfile.TemporaryDirectory() as root:
+            steam_path = Path(root) / 'steam'
+            steam_path.mkdir()
+            users = create_steam_tree(steam_path, user_count)
+            config = create_config(server.url, args.requests_per_second, str(steam_path), grid_count, category_count, weeks, users, stratz_config, grid_config)
+
+            start = time.perf_counter()
+            stratz_client = asyncio.run(run_scenario(config, Path(root) / 'cache'))
+            wall = time.perf_counter() - start
+            request_count = fake_stratz.request_count
+
+            # Tracing allocations slows everything down, so memory is measured in a separate run.
+            HeroGridCategory.built.clear()
+            layout_category.cache_clear()
+            tracemalloc.start()
+            asyncio.run(run_scenario(config, Path(root) / 'cache'))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        print('{:<22} {:>9.3f} {:>9} {:>13.3f} {:>13.2f}'.format(
+            name,
+            wall,
+            request_count,
+            stratz_client.rate_limiter.waited,
+            peak / 1024 / 1024
+        ))
+
+
+if __name__ == '__main__':
+    main()
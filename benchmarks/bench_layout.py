@@ -0,0 +1,158 @@
+"""
+Micro-benchmark of laying out configs with thousands of categories, comparing the previous layout (a closure per
+category, then a second pass shifting every entry down by the height of the categories above it) with
+`layout_grid`. It's measured cold, where only grids repeating the same categories benefit from the memo, and warm,
+like regenerating in daemon mode. Configs stay within LAYOUT_CACHE_SIZE categories, above which the memo stops
+helping.
+
+Run from the repository root:
+
+    python benchmarks/bench_layout.py
+"""
+
+import argparse
+from pathlib import Path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dota_hero_grid_generator import (
+    HERO_HEIGHT,
+    HERO_REAL_HEIGHT,
+    HERO_REAL_WIDTH,
+    HERO_WIDTH,
+    layout_category,
+    layout_grid
+)
+
+
+HERO_COUNT = 124
+CATEGORIES_PER_GRID = 10
+
+
+def generate_grids(count, distinct):
+    """
+    `count` grids, cycling through `distinct` different ones, each a list of the arguments of `layout_category`.
+    """
+
+    rng = random.Random(count * 10 + distinct)
+    grids = []
+    for i in range(distinct):
+        categories = []
+        for j in range(CATEGORIES_PER_GRID):
+            heroes = [(hero_id, round(rng.uniform(40, 60), 2), round(rng.uniform(0, 20), 2)) for hero_id in rng.sample(range(1, HERO_COUNT + 1), 40)]
+            split = rng.randint(10, 35)
+            categories.append((f'Category {j}', tuple(heroes[:split]), tuple(heroes[split:]), j % 2 == 0))
+
+        grids.append(categories)
+
+    return [grids[i % distinct] for i in range(count)]
+
+
+def previous_layout_category(name, heroes, outliers, show_pickrates):
+    data = [{'category_name': name, 'x_position': 0, 'y_position': 0, 'width': 0, 'height': 0, 'hero_ids': []}]
+    real_height = 0
+    x_position = 0
+    y_position = HERO_REAL_HEIGHT - HERO_HEIGHT
+    def generate_hero(hero, start_x_position=0, end_x_position=1200):
+        nonlocal x_position
+        nonlocal y_position
+
+        hero_id, win_rate, pick_rate = hero
+        if show_pickrates:
+            data.append({'category_name': '  {:.2f}%'.format(win_rate), 'x_position': x_position, 'y_position': y_position, 'width': 0, 'height': 0, 'hero_ids': []})
+            data.append({'category_name': '  {:.2f}%'.format(pick_rate), 'x_position': x_position, 'y_position': y_position + 20, 'width': HERO_WIDTH, 'height': HERO_HEIGHT, 'hero_ids': [hero_id]})
+            if x_position + HERO_REAL_WIDTH * 2 > end_x_position:
+                x_position = start_x_position
+                y_position += HERO_REAL_HEIGHT + 20
+            else:
+                x_position += HERO_REAL_WIDTH
+        else:
+            data.append({'category_name': '  {:.2f}%'.format(win_rate), 'x_position': x_position, 'y_position': y_position, 'width': HERO_WIDTH, 'height': HERO_HEIGHT, 'hero_ids': [hero_id]})
+            if x_position + HERO_REAL_WIDTH * 2 > end_x_position:
+                x_position = start_x_position
+                y_position += HERO_REAL_HEIGHT
+            else:
+                x_position += HERO_REAL_WIDTH
+
+    for hero in heroes:
+        generate_hero(hero)
+
+    if outliers:
+        if x_position != 0:
+            y_position += HERO_REAL_HEIGHT
+            if show_pickrates:
+                y_position += 20
+
+        x_position = HERO_REAL_WIDTH
+        data.append({'category_name': f'Outliers: {name}', 'x_position': x_position, 'y_position': y_position, 'width': 0, 'height': 0, 'hero_ids': []})
+        y_position += HERO_REAL_HEIGHT - HERO_HEIGHT
+        for hero in outliers:
+            generate_hero(hero, HERO_REAL_WIDTH, 1200 - HERO_REAL_WIDTH)
+
+        if x_position == HERO_REAL_WIDTH:
+            x_position = 0
+
+    if x_position == 0:
+        real_height += y_position
+    else:
+        real_height += y_position + HERO_REAL_HEIGHT
+        if show_pickrates:
+            real_height += 20
+
+    return data, real_height
+
+
+def previous_layout_grid(categories):
+    laid_out = [previous_layout_category(*category) for category in categories]
+
+    entries = []
+    cumulated_height = 0
+    for i, (data, real_height) in enumerate(laid_out):
+        if i > 0:
+            for entry in data:
+                entry['y_position'] += cumulated_height
+
+        entries.extend(data)
+        cumulated_height += real_height + 60
+
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks laying out configs with many categories.')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the fastest is reported (default: 3)')
+    args = parser.parse_args()
+
+    def previous():
+        return [previous_layout_grid(grid) for grid in grids]
+
+    def current():
+        return [layout_grid(grid) for grid in grids]
+
+    print('{:>11} {:>6} {:>9} {:>14} {:>11} {:>11} {:>13}'.format('categories', 'grids', 'distinct', 'previous (ms)', 'cold (ms)', 'warm (ms)', 'warm speedup'))
+    for category_count in (1000, 2000, 4000):
+        grid_count = category_count // CATEGORIES_PER_GRID
+        for distinct in (grid_count, grid_count // 10):
+            grids = generate_grids(grid_count, distinct)
+            assert previous() == current()
+
+            previous_time = min(timeit.repeat(previous, number=1, repeat=args.repeat))
+            cold_time = min(timeit.repeat(current, setup=layout_category.cache_clear, number=1, repeat=args.repeat))
+            current()
+            warm_time = min(timeit.repeat(current, number=1, repeat=args.repeat))
+            print('{:>11} {:>6} {:>9} {:>14.2f} {:>11.2f} {:>11.2f} {:>12.1f}x'.format(
+                category_count,
+                grid_count,
+                distinct,
+                previous_time * 1000,
+                cold_time * 1000,
+                warm_time * 1000,
+                previous_time / warm_time
+            ))
+
+
+if __name__ == '__main__':
+    main()
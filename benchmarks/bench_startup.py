@@ -0,0 +1,105 @@
+"""
+Startup benchmark, based on `python -X importtime`.
+
+Measures how long importing the generator takes and which modules dominate it, then does a full run against a warm
+cache in a fresh interpreter, checking that it finishes without ever importing the HTTP stack.
+
+Run from the repository root:
+
+    python benchmarks/bench_startup.py
+"""
+
+import argparse
+import json
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench_e2e import FakeStratzServer, create_config, create_steam_tree
+from fake_stratz import FakeStratz
+
+
+SCRIPT_PATH = Path(__file__).resolve().parent.parent / 'dota_hero_grid_generator.py'
+
+HTTP_MODULES = ('aiohttp', 'multidict', 'yarl', 'aiohappyeyeballs')
+
+
+def parse_importtime(stderr):
+    """
+    Returns (module, self time in us, cumulative time in us) for every import. Nested imports are indented.
+    """
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+
+        self_time, cumulative_time, name = line[len('import time:'):].split('|')
+        if self_time.strip() == 'self [us]':
+            continue
+
+        imports.append((name[1:].rstrip(), int(self_time), int(cumulative_time)))
+
+    return imports
+
+
+def run_importtime(args, cwd=None):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True
+    )
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stdout + result.stderr)
+
+    return wall, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks startup time of the generator.')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the fastest is reported (default: 5)')
+    parser.add_argument('--top', type=int, default=10, help='how many of the slowest imports to list (default: 10)')
+    args = parser.parse_args()
+
+    import_code = f'import sys; sys.path.insert(0, {str(SCRIPT_PATH.parent)!r}); import dota_hero_grid_generator'
+    runs = [run_importtime(['-c', import_code])[1] for _ in range(args.repeat)]
+    imports = min(runs, key=lambda run: next(cumulative for name, _, cumulative in run if name == 'dota_hero_grid_generator'))
+
+    # Direct imports of the generator are the ones nested exactly one level deep.
+    direct_imports = [(name.strip(), cumulative) for name, _, cumulative in imports if name.startswith('  ') and not name.startswith('    ')]
+    total = next(cumulative for name, _, cumulative in imports if name == 'dota_hero_grid_generator')
+    print('Importing the generator: {:.1f} ms'.format(total / 1000))
+    for name, cumulative in sorted(direct_imports, key=lambda entry: entry[1], reverse=True)[:args.top]:
+        print('    {:<40} {:>8.1f} ms'.format(name, cumulative / 1000))
+
+    with FakeStratzServer(FakeStratz(0)) as server, tempfile.TemporaryDirectory() as root:
+        steam_path = Path(root) / 'steam'
+        steam_path.mkdir()
+        users = create_steam_tree(steam_path, 1)
+        config = create_config(server.url, 100, str(steam_path), 1, 5, 4, users, {})
+        config['cache'] = {'path': str(Path(root) / 'cache'), 'ttl': 60 * 60}
+
+        config_path = Path(root) / 'config.json'
+        with open(config_path, 'w', encoding='utf-8') as fp:
+            json.dump(config, fp)
+
+        # Warm the cache up.
+        subprocess.run([sys.executable, str(SCRIPT_PATH), '--config', str(config_path)], cwd=root, capture_output=True, check=True)
+
+        runs = [run_importtime([str(SCRIPT_PATH), '--config', str(config_path)], cwd=root) for _ in range(args.repeat)]
+        wall, imports = min(runs, key=lambda run: run[0])
+
+    http_modules = sorted({name.strip().split('.')[0] for name, _, _ in imports if name.strip().split('.')[0] in HTTP_MODULES})
+    print('Full run with a warm cache: {:.1f} ms'.format(wall * 1000))
+    print('HTTP modules imported: {}'.format(', '.join(http_modules) if http_modules else 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Local stand-in for the Stratz GraphQL API, serving synthetic `winWeek` data.
+
+Only understands the `heroStats { winWeek(...) }` documents the generator sends, aliased or not. Data is
+deterministic: every (week, rank, position, mode) combination gets its own seeded numbers, and queries for several
+ranks or positions get those numbers summed up, like the real API does.
+
+Run it on its own with:
+
+    python benchmarks/fake_stratz.py --port 8765
+
+and point `stratz.api_url` in the config at http://127.0.0.1:8765/graphql.
+"""
+
+import argparse
+import asyncio
+import random
+import re
+import time
+
+from aiohttp import web
+
+
+HERO_COUNT = 124
+WEEK = 7 * 24 * 60 * 60
+
+WIN_WEEK_PATTERN = re.compile(
+    r'(?:(\w+)\s*:\s*)?winWeek\(\s*'
+    r'take:\s*(\d+),\s*'
+    r'bracketIds:\s*\[([^\]]*)\],\s*'
+    r'positionIds:\s*\[([^\]]*)\],\s*'
+    r'gameModeIds:\s*\[([^\]]*)\]'
+    r'\s*\)'
+)
+
+
+def split_enum_list(text):
+    return sorted(item.strip() for item in text.split(',') if item.strip())
+
+
+class FakeStratz:
+    def __init__(self, latency=0.05, requests_per_second=None, hero_count=HERO_COUNT):
+        self.latency = latency
+        self.requests_per_second = requests_per_second
+        self.hero_count = hero_count
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.recent_requests = []
+        self.current_week = int(time.time()) // WEEK * WEEK
+
+    def rows(self, take, ranks, positions, modes):
+        totals = {}
+        for week_index in range(take):
+            week = self.current_week - week_index * WEEK
+            for rank in ranks:
+                for position in positions:
+                    for mode in modes:
+                        rng = random.Random(f'{week}|{rank}|{position}|{mode}')
+                        for hero_id in range(1, self.hero_count + 1):
+                            match_count = rng.randint(100, 5000)
+                            win_count = int(match_count * rng.uniform(0.4, 0.6))
+                            total = totals.setdefault((week, hero_id), [0, 0])
+                            total[0] += match_count
+                            total[1] += win_count
+
+        return [
+            {'week': week, 'heroId': hero_id, 'matchCount': match_count, 'winCount': win_count}
+            for (week, hero_id), (match_count, win_count) in totals.items()
+        ]
+
+    def is_rate_limited(self):
+        if self.requests_per_second is None:
+            return False
+
+        now = time.monotonic()
+        self.recent_requests = [timestamp for timestamp in self.recent_requests if timestamp > now - 1]
+        if len(self.recent_requests) >= self.requests_per_second:
+            return True
+
+        self.recent_requests.append(now)
+        return False
+
+    async def handle(self, request):
+        self.request_count += 1
+        if self.is_rate_limited():
+            self.rate_limited_count += 1
+            return web.json_response({'message': 'API rate limit exceeded'}, status=429, headers={'Retry-After': '1'})
+
+        query = (await request.json())['query']
+        win_weeks = {}
+        for match in WIN_WEEK_PATTERN.finditer(query):
+            alias, take, ranks, positions, modes = match.groups()
+            win_weeks[alias or 'winWeek'] = self.rows(
+                int(take),
+                split_enum_list(ranks),
+                split_enum_list(positions),
+                split_enum_list(modes)
+            )
+
+        await asyncio.sleep(self.latency)
+        return web.json_response({'data': {'heroStats': win_weeks}})
+
+    def create_app(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post('/graphql', self.handle)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the Stratz GraphQL API.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds to wait before each response')
+    parser.add_argument('--requests-per-second', type=int, default=None, help='answer with 429 above this rate')
+    args = parser.parse_args()
+
+    fake_stratz = FakeStratz(args.latency, args.requests_per_second)
+    web.run_app(fake_stratz.create_app(), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,27 @@
 import warnings
 warnings.filterwarnings('ignore')
 
-import aiohttp
+# Only modules needed on every run are imported up front. The HTTP stack (aiohttp) and vdf are imported where they're
+# used, so that a run served entirely from the cache starts quickly and never loads them.
+import argparse
 import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import itertools
 import json
+import math
 import os
 from pathlib import Path
-import socket
+import random
 import sys
-import traceback
 import time
-import uuid
-import vdf
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 DOTA2_APP_ID = 570
@@ -25,6 +35,34 @@ class Error(Exception):
     pass
 
 
+class TimedOut(Error):
+    """
+    Stratz didn't respond in time, either to a single request or before the run's deadline.
+    """
+
+
+def json_loads(data):
+    """
+    Parses JSON straight from bytes (or a string), with orjson if it's installed.
+    """
+
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def json_dumps(data):
+    """
+    Serializes to compact JSON, with orjson if it's installed.
+    """
+
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    return json.dumps(data, separators=(',', ':'))
+
+
 class SteamUser:
     def __init__(self, account_name, persona_name, id64):
         self.account_name = account_name
@@ -33,14 +71,1189 @@ class SteamUser:
         self.id3 = self.id64 - 76561197960265728 # https://github.com/arhi3a/Steam-ID-Converter/blob/master/steam_id_converter.py#L7
 
 
+class Tracer:
+    """
+    Collects timing spans and counters over a run, so that it can be dumped with --trace. Spans are only kept
+    while `enabled`, otherwise a process running for weeks would keep piling them up.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.spans = []
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        if not self.enabled:
+            yield attributes
+            return
+
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            end = time.perf_counter()
+            self.spans.append(dict(attributes, name=name, start=start - self.started, duration=end - start))
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def summary(self):
+        summary = {}
+        for span in self.spans:
+            entry = summary.setdefault(span['name'], {'count': 0, 'total': 0, 'max': 0})
+            entry['count'] += 1
+            entry['total'] += span['duration']
+            entry['max'] = max(entry['max'], span['duration'])
+
+        return summary
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as fp:
+            json.dump({
+                'duration': time.perf_counter() - self.started,
+                'counters': self.counters,
+                'summary': self.summary(),
+                'spans': self.spans
+            }, fp, indent=4)
+
+
+tracer = Tracer()
+
+
+class StratzQuery:
+    def __init__(self, take_weeks, ranks, positions, modes):
+        self.take_weeks = take_weeks
+        self.ranks = tuple(sorted({rank.upper() for rank in ranks}))
+        self.positions = tuple(sorted(set(positions)))
+        self.modes = tuple(sorted({mode.upper() for mode in modes}))
+
+    @property
+    def key(self):
+        return (self.take_weeks, self.ranks, self.positions, self.modes)
+
+    @property
+    def dims(self):
+        return (self.ranks, self.positions, self.modes)
+
+    def __eq__(self, other):
+        return isinstance(other, StratzQuery) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def split(self, positions=False, ranks=False):
+        """
+        Splits the query into the finest-grained queries whose rows add up to this query's rows.
+        """
+
+        return [
+            StratzQuery(self.take_weeks, rank, position, self.modes)
+            for rank, position in itertools.product(
+                [[rank] for rank in self.ranks] if ranks else [self.ranks],
+                [[position] for position in self.positions] if positions else [self.positions]
+            )
+        ]
+
+    def selection(self, alias, weeks=False):
+        fields = ',\n                        '.join(['week', 'heroId', 'matchCount', 'winCount'] if weeks else ['heroId', 'matchCount', 'winCount'])
+        return f'''
+                    {alias}: winWeek(
+                        take: {self.take_weeks},
+                        bracketIds: [{','.join(self.ranks)}],
+                        positionIds: [{','.join([f'POSITION_{position}' for position in self.positions])}],
+                        gameModeIds: [{','.join(self.modes)}]
+                    ) {{
+                        {fields}
+                    }}'''
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request to Stratz. Waiters are served in arrival order and sleep exactly until
+    the next token frees up. When Stratz pushes back, the rate is halved and every request is held back for as long
+    as Stratz asked. Pushback on requests sent before that doesn't count again. The rate then creeps back up over
+    `RECOVERY_TIME` seconds, but only to a `ceiling` a bit below the rate Stratz last pushed back at, so that it
+    settles just under whatever Stratz actually allows.
+    """
+
+    MIN_RATE = 1 / 60
+    RECOVERY_TIME = 60
+    CEILING_MARGIN = 0.9
+
+    def __init__(self, requests_per_second):
+        self.max_rate = requests_per_second
+        self.ceiling = requests_per_second
+        self.rate = requests_per_second
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.slowed_at = -math.inf
+        self.lock = asyncio.Lock()
+        self.waited = 0
+
+    @property
+    def capacity(self):
+        return max(1, self.rate)
+
+    async def acquire(self):
+        async with self.lock:
+            start = time.monotonic()
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.rate = min(self.ceiling, self.rate + (now - self.updated) * self.ceiling / self.RECOVERY_TIME)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+            waited = time.monotonic() - start
+            self.waited += waited
+            tracer.count('rate_limiter.wait', waited)
+
+    def reconfigure(self, requests_per_second):
+        # What was learned about Stratz's limit still holds, unless the configured rate changed.
+        if requests_per_second != self.max_rate:
+            self.ceiling = requests_per_second
+
+        self.max_rate = requests_per_second
+        self.ceiling = min(self.ceiling, requests_per_second)
+        self.rate = min(self.rate, requests_per_second)
+
+    def slow_down(self, sent_at, retry_after=None):
+        """
+        Handles pushback on a request sent at `sent_at`, a `time.monotonic()` timestamp. Returns whether the rate
+        was lowered, which it isn't for requests already on their way when it last was.
+        """
+
+        if sent_at < self.slowed_at:
+            return False
+
+        self.ceiling = max(self.MIN_RATE, self.rate * self.CEILING_MARGIN)
+        self.rate = max(self.MIN_RATE, self.rate / 2)
+        self.tokens = 0
+        self.updated = self.slowed_at = time.monotonic()
+        self.paused_until = max(self.paused_until, self.updated + (retry_after if retry_after is not None else 1 / self.rate))
+        return True
+
+
+class StratzClient:
+    """
+    Requests time out after `timeout` seconds. Transient failures (timeouts, network errors, server errors and
+    garbled responses) are retried up to `retries` times, after a random delay of up to `retry_backoff` seconds,
+    doubling with each retry.
+
+    With a `hedge_percentile`, a request that takes longer than that percentile of recent response times gets
+    a duplicate sent alongside it, within the rate limit, and whichever responds first is used.
+    """
+
+    API_URL = 'https://api.stratz.com/graphql'
+    MAX_RATE_LIMITED_ATTEMPTS = 5
+
+    DEFAULT_TIMEOUT = 60
+    DEFAULT_RETRIES = 2
+    DEFAULT_RETRY_BACKOFF = 1
+    MAX_RETRY_BACKOFF = 30
+
+    LATENCY_SAMPLES = 100
+    MIN_LATENCY_SAMPLES = 10
+
+    def __init__(
+        self,
+        token,
+        requests_per_second,
+        http_session=None,
+        api_url=API_URL,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        retry_backoff=DEFAULT_RETRY_BACKOFF,
+        hedge_percentile=None
+    ):
+        self.token = token
+        self.api_url = api_url
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.hedge_percentile = hedge_percentile
+        self.http_session = http_session
+        self.owns_http_session = False
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.request_count = 0
+        self.latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+
+    def get_http_session(self):
+        """
+        The HTTP session is only created once the first request is about to be sent.
+        """
+
+        if self.http_session is None:
+            import aiohttp
+            import socket
+
+            connector = aiohttp.TCPConnector(
+                family=socket.AF_INET,
+                ssl=False,
+                limit=self.rate_limiter.max_rate
+            )
+
+            cookie_jar = aiohttp.CookieJar(unsafe=True)
+
+            self.http_session = aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar)
+            self.owns_http_session = True
+
+        return self.http_session
+
+    async def close(self):
+        if self.owns_http_session:
+            await self.http_session.close()
+            self.http_session = None
+            self.owns_http_session = False
+
+    async def post(self, query):
+        start = time.monotonic()
+        resp = await self.get_http_session().post(
+            self.api_url,
+            data=json_dumps({'query': query}),
+            headers = {
+                'User-Agent': 'STRATZ_API',
+                'Authorization': f'Bearer {self.token}',
+                'Content-Type': 'application/json'
+            }
+        )
+
+        body = await resp.read()
+        self.latencies.append(time.monotonic() - start)
+        return resp, body
+
+    def hedge_delay(self):
+        if self.hedge_percentile is None or len(self.latencies) < self.MIN_LATENCY_SAMPLES:
+            return None
+
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
+
+    async def send(self, query):
+        """
+        Posts the query, hedging it if it's slow, and returns the first response.
+        """
+
+        posts = {asyncio.ensure_future(self.post(query))}
+        try:
+            hedge_delay = self.hedge_delay()
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(posts, timeout=hedge_delay)
+                if not done:
+                    posts.add(asyncio.ensure_future(self.hedge(query)))
+
+            while True:
+                done, posts = await asyncio.wait(posts, return_when=asyncio.FIRST_COMPLETED)
+                for post in done:
+                    if post.exception() is None or not posts:
+                        return post.result()
+        finally:
+            for post in posts:
+                post.cancel()
+
+    async def hedge(self, query):
+        """
+        Sends a duplicate of a slow request once the rate limiter allows it. It's called off if the original
+        responds first, even while still waiting for a token.
+        """
+
+        await self.rate_limiter.acquire()
+        self.request_count += 1
+        tracer.count('stratz.requests')
+        tracer.count('stratz.hedges')
+        return await self.post(query)
+
+    async def back_off(self, retry):
+        delay = random.uniform(0, min(self.retry_backoff * 2 ** (retry - 1), self.MAX_RETRY_BACKOFF))
+        tracer.count('stratz.retries')
+        tracer.count('stratz.backoff', delay)
+        await asyncio.sleep(delay)
+
+    async def request(self, query, acquired=False):
+        """
+        Returns the response's data, along with the messages of any errors that came with it, since GraphQL can
+        fail for parts of a query while answering the rest.
+
+        With `acquired`, the caller already took a token from the rate limiter for the first attempt.
+        """
+
+        with tracer.span('stratz.request') as span:
+            return await self._request(query, span, acquired)
+
+    async def _request(self, query, span, acquired):
+        import aiohttp
+
+        rate_limited = 0
+        retries = 0
+        for attempt in itertools.count(1):
+            if attempt > 1 or not acquired:
+                await self.rate_limiter.acquire()
+
+            sent_at = time.monotonic()
+            self.request_count += 1
+            tracer.count('stratz.requests')
+            span['attempts'] = attempt
+            try:
+                with tracer.span('stratz.response'):
+                    resp, body = await asyncio.wait_for(self.send(query), self.timeout)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    tracer.count('stratz.timeouts')
+                    error = TimedOut(f'Stratz didn\'t respond within {self.timeout} seconds.')
+                else:
+                    error = Error('Something happened with the network. Maybe Stratz is unavailable or your internet is down.')
+
+                if retries < self.retries:
+                    retries += 1
+                    await self.back_off(retries)
+                    continue
+
+                raise error
+
+            span['status'] = resp.status
+            span['size'] = len(body)
+            tracer.count('stratz.response_bytes', len(body))
+
+            with tracer.span('stratz.parse', size=len(body)):
+                try:
+                    payload = json_loads(body)
+                except ValueError:
+                    payload = None
+
+            message = payload.get('message') if isinstance(payload, dict) else None
+
+            if resp.status == 429 or message == 'API rate limit exceeded':
+                try:
+                    retry_after = float(resp.headers['Retry-After'])
+                except (KeyError, ValueError):
+                    retry_after = None
+
+                tracer.count('stratz.rate_limited')
+                # Pushback on a request that was already on its way when the rate was lowered says nothing new.
+                if self.rate_limiter.slow_down(sent_at, retry_after):
+                    rate_limited += 1
+                    if rate_limited == self.MAX_RATE_LIMITED_ATTEMPTS:
+                        raise Error('Stratz kept rate-limiting us. Lower requests_per_second in the configuration file.')
+
+                    print('Warning: Stratz is rate-limiting us, slowing down to {:.2f} requests per second.'.format(self.rate_limiter.rate))
+
+                continue
+
+            # Server errors and garbled responses usually don't happen twice in a row.
+            if (resp.status >= 500 or payload is None) and retries < self.retries:
+                retries += 1
+                await self.back_off(retries)
+                continue
+
+            break
+
+        errors = self.error_messages(payload)
+        if isinstance(payload, dict) and isinstance(payload.get('data'), dict):
+            return payload['data'], errors
+
+        if message is not None and message.startswith('A bearer token is required for a request'):
+            raise Error('Your Stratz API token has expired. Refresh it at https://stratz.com/api.')
+
+        if errors is not None:
+            details = errors
+        elif payload is None:
+            details = 'The response isn\'t valid JSON.'
+        else:
+            details = 'The response has no data.'
+
+        raise Error(f'Failed to parse data from Stratz. The API may be down, your connection unstable, '
+                    f'or something else. Exact error:\n\n{details}\n\nData:{body.decode("utf-8", "replace")}')
+
+
+    @staticmethod
+    def error_messages(payload):
+        if not isinstance(payload, dict) or not payload.get('errors') or not isinstance(payload['errors'], list):
+            return None
+
+        return '\n'.join(str(error.get('message', error) if isinstance(error, dict) else error) for error in payload['errors'])
+
+
+class StratzCache:
+    """
+    On-disk cache of Stratz query results, keyed by a hash of the normalized query.
+    Entries fetched more than `ttl` seconds ago are ignored unless `offline` is set, and the least recently used
+    entries are evicted once the cache grows past `max_size` megabytes, counting a week store kept within the cache's
+    folder. Entries keep the time they were fetched at, while their files' mtime tracks when they were last used.
+    """
+
+    def __init__(self, path, ttl, max_size, offline=False):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_size = max_size * 1024 * 1024
+        self.offline = offline
+
+    def entry_path(self, query):
+        digest = hashlib.sha256(json.dumps(query.key).encode('utf-8')).hexdigest()
+        return self.path / f'{digest}.json'
+
+    def get(self, query, stale=False):
+        """
+        With `stale`, entries are returned however old they are.
+        """
+
+        path = self.entry_path(query)
+        try:
+            with open(path, 'rb') as fp:
+                entry = json_loads(fp.read())
+
+            rows = entry['rows']
+            if not self.offline and not stale and time.time() - entry.get('fetched', 0) > self.ttl:
+                return None
+
+            os.utime(path)
+            return rows
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def set(self, query, rows):
+        if self.ttl <= 0:
+            return
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        path = self.entry_path(query)
+        temp_path = path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as fp:
+            fp.write(json_dumps({'query': query.key, 'fetched': time.time(), 'rows': rows}))
+
+        os.replace(temp_path, path)
+
+    def evict(self):
+        try:
+            entries = [(path, path.stat()) for path in self.path.rglob('*.json')]
+        except OSError:
+            return
+
+        size = sum(stat.st_size for _, stat in entries)
+        for path, stat in sorted(entries, key=lambda entry: entry[1].st_mtime):
+            if size <= self.max_size:
+                break
+
+            try:
+                path.unlink()
+                size -= stat.st_size
+            except OSError:
+                pass
+
+
+class StratzWeekStore:
+    """
+    Per-week, per-hero counts for every combination of ranks, positions and modes, kept on disk, so that only weeks
+    which aren't stored yet have to be fetched. Any number of weeks is then assembled locally from the stored ones.
+    """
+
+    MAX_WEEKS = 104
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.series = {}
+
+    def entry_path(self, query):
+        digest = hashlib.sha256(json.dumps(query.dims).encode('utf-8')).hexdigest()
+        return self.path / f'{digest}.json'
+
+    def weeks(self, query):
+        if query.dims not in self.series:
+            try:
+                path = self.entry_path(query)
+                with open(path, 'rb') as fp:
+                    self.series[query.dims] = {int(week): rows for week, rows in json_loads(fp.read())['weeks'].items()}
+
+                # Marks the series as recently used, for the cache's eviction.
+                os.utime(path)
+            except (OSError, ValueError, KeyError):
+                self.series[query.dims] = {}
+
+        return self.series[query.dims]
+
+    def weeks_to_fetch(self, query):
+        weeks = self.weeks(query)
+        if not weeks:
+            return query.take_weeks
+
+        # A new week can only have started a full week after the newest stored one, which is fetched again in case
+        # it was still in progress back then. That one is fetched even if the local clock is behind Stratz's.
+        newest = max(weeks)
+        take_weeks = max(1, min(query.take_weeks, int((time.time() - newest) // STRATZ_WEEK) + 1))
+        if all(newest - i * STRATZ_WEEK in weeks for i in range(1, query.take_weeks - take_weeks + 1)):
+            return take_weeks
+
+        return query.take_weeks
+
+    def merge(self, query, rows):
+        weeks = self.weeks(query)
+        fetched_weeks = {}
+        for row in rows:
+            fetched_weeks.setdefault(row['week'], []).append([row['heroId'], row['matchCount'], row['winCount']])
+
+        weeks.update(fetched_weeks)
+        if weeks:
+            newest = max(weeks)
+            for week in [week for week in weeks if week <= newest - self.MAX_WEEKS * STRATZ_WEEK]:
+                del weeks[week]
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        path = self.entry_path(query)
+        temp_path = path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as fp:
+            fp.write(json_dumps({'query': query.dims, 'weeks': weeks}))
+
+        os.replace(temp_path, path)
+
+    def window(self, query):
+        """
+        Rows of the newest `take_weeks` weeks, or None if any of them isn't stored.
+        """
+
+        weeks = self.weeks(query)
+        if not weeks:
+            return None
+
+        newest = max(weeks)
+        window = [newest - i * STRATZ_WEEK for i in range(query.take_weeks)]
+        if not all(week in weeks for week in window):
+            return None
+
+        return [
+            {'week': week, 'heroId': hero_id, 'matchCount': match_count, 'winCount': win_count}
+            for week in window
+            for hero_id, match_count, win_count in weeks[week]
+        ]
+
+
+class StratzSnapshot:
+    """
+    Everything fetched from Stratz for a run, in one compact file, so that grids can be generated from it on any
+    machine, with no token or network access, and always the same way.
+
+    The file is MAGIC, a version byte, and a zlib-compressed body: a little-endian uint32 length, a JSON header
+    listing the queries and their row counts, and then the columns of every query, one after another. Columns are
+    hero IDs (uint16), match and win counts (uint32), and weeks (int64) for queries whose rows have them.
+    The split options the data was fetched with are kept too, since they decide which queries there are.
+    """
+
+    MAGIC = b'DHGSNAP'
+    VERSION = 1
+
+    COLUMNS = (('heroId', 'H'), ('matchCount', 'I'), ('winCount', 'I'))
+    WEEK_COLUMN = ('week', 'q')
+
+    def __init__(self, results, split_positions=False, split_ranks=False, created=None):
+        self.results = results
+        self.split_positions = split_positions
+        self.split_ranks = split_ranks
+        self.created = time.time() if created is None else created
+
+    @classmethod
+    def from_planner(cls, query_planner):
+        """
+        Takes every query the planner got data for, including data it fell back to.
+        """
+
+        results = {}
+        for query, future in query_planner.futures.items():
+            if future.done() and future.exception() is None:
+                results[query] = future.result()
+
+        return cls(results, query_planner.split_positions, query_planner.split_ranks)
+
+    def get(self, query):
+        return self.results.get(query)
+
+    def save(self, path):
+        import array
+        import zlib
+
+        queries = []
+        columns = []
+        for query, rows in self.results.items():
+            weeks = all('week' in row for row in rows)
+            queries.append({'key': query.key, 'rows': len(rows), 'weeks': weeks})
+            for name, typecode in self.COLUMNS + ((self.WEEK_COLUMN,) if weeks else ()):
+                column = array.array(typecode, [row[name] for row in rows])
+                if sys.byteorder == 'big':
+                    column.byteswap()
+
+                columns.append(column.tobytes())
+
+        header = json_dumps({
+            'created': self.created,
+            'split_positions': self.split_positions,
+            'split_ranks': self.split_ranks,
+            'queries': queries
+        }).encode('utf-8')
+
+        body = len(header).to_bytes(4, 'little') + header + b''.join(columns)
+
+        path = Path(path)
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'wb') as fp:
+            fp.write(self.MAGIC + bytes([self.VERSION]) + zlib.compress(body, 9))
+
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        import array
+        import zlib
+
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except OSError as e:
+            raise Error(f'Couldn\'t read the snapshot {path}: {e.strerror}.')
+
+        if not data.startswith(cls.MAGIC) or len(data) == len(cls.MAGIC):
+            raise Error(f'{path} isn\'t a snapshot.')
+
+        version = data[len(cls.MAGIC)]
+        if version != cls.VERSION:
+            raise Error(f'The snapshot {path} is of version {version}, but only version {cls.VERSION} is supported.')
+
+        try:
+            body = zlib.decompress(data[len(cls.MAGIC) + 1:])
+            header_length = int.from_bytes(body[:4], 'little')
+            header = json_loads(body[4:4 + header_length])
+
+            results = {}
+            offset = 4 + header_length
+            for entry in header['queries']:
+                if not isinstance(entry['rows'], int) or entry['rows'] < 0:
+                    raise ValueError('Invalid row count.')
+
+                columns = {}
+                for name, typecode in cls.COLUMNS + ((cls.WEEK_COLUMN,) if entry['weeks'] else ()):
+                    column = array.array(typecode)
+                    size = column.itemsize * entry['rows']
+                    if offset + size > len(body):
+                        raise ValueError('The body is too short.')
+
+                    column.frombytes(body[offset:offset + size])
+                    if sys.byteorder == 'big':
+                        column.byteswap()
+
+                    columns[name] = column
+                    offset += size
+
+                results[StratzQuery(*entry['key'])] = [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+            if offset != len(body):
+                raise ValueError('The body is too long.')
+
+            return cls(results, header['split_positions'], header['split_ranks'], header['created'])
+        except (zlib.error, ValueError, KeyError, TypeError, IndexError):
+            raise Error(f'The snapshot {path} is corrupted.')
+
+
+class StratzQueryPlanner:
+    """
+    Collects the queries of every category before anything is sent, so that each distinct query
+    hits Stratz only once and its result is fanned out to all the categories which asked for it.
+    Up to `batch_size` queries are packed into a single GraphQL document using field aliases.
+    Queries found in `cache` never reach Stratz at all, unless a `refresh` is requested.
+
+    With `split_positions`, queries are only ever sent for single positions, and multi-position queries are summed up
+    locally from those, so that they share data with single-position categories. `split_ranks` does the same for ranks.
+
+    With a `week_store`, only the weeks it's missing are fetched, and the rest is assembled from it.
+
+    Queries that Stratz doesn't answer in time, or at all before the `deadline`, are served from expired cache entries
+    or the week store's newest weeks if possible, and marked as stale.
+
+    With a `snapshot`, everything comes from it instead, and nothing is ever fetched.
+
+    Grids registered with the planner have their queries sent in the order picked by a `StratzFetchScheduler`.
+    """
+
+    def __init__(self, batch_size=1, cache=None, split_positions=False, split_ranks=False, week_store=None, snapshot=None):
+        self.batch_size = batch_size
+        self.cache = cache
+        self.split_positions = split_positions
+        self.split_ranks = split_ranks
+        self.week_store = week_store
+        self.snapshot = snapshot
+        self.parts = {}
+        self.futures = {}
+        self.digests = {}
+        self.tables = {}
+        self.stale = set()
+        self.grids = {}
+
+    def add(self, query):
+        if query not in self.parts:
+            self.parts[query] = query.split(self.split_positions, self.split_ranks)
+            for part in self.parts[query]:
+                if part not in self.futures:
+                    self.futures[part] = asyncio.get_running_loop().create_future()
+
+        return query
+
+    def register(self, hero_grid):
+        """
+        Records which queries a grid waits on, once all of its categories have been added.
+        """
+
+        self.grids[hero_grid] = {part for category in hero_grid.hero_grid_categories for part in self.parts[category.query]}
+
+    async def result(self, query):
+        parts = self.parts[query]
+        if len(parts) == 1:
+            return await self.futures[parts[0]]
+
+        rows = []
+        for part_rows in await asyncio.gather(*[self.futures[part] for part in parts]):
+            rows.extend(part_rows)
+
+        return rows
+
+    async def table(self, query):
+        """
+        A query's result aggregated per hero, shared by every category built from it.
+        """
+
+        rows = await self.result(query)
+        if query not in self.tables:
+            with tracer.span('stats.aggregate', rows=len(rows)):
+                self.tables[query] = HeroStatsTable(rows)
+
+        return self.tables[query]
+
+    def is_stale(self, query):
+        return any(part in self.stale for part in self.parts[query])
+
+    async def digest(self, query):
+        """
+        Content digest of a query's result, used to tell whether anything built from it needs rebuilding.
+        """
+
+        if query not in self.digests:
+            self.digests[query] = content_digest(json_dumps(await self.result(query)))
+
+        return self.digests[query]
+
+    async def execute(self, stratz_client, refresh=False, deadline=None):
+        """
+        `deadline` is a `time.monotonic()` timestamp by which fetching has to be over.
+        """
+
+        pending = []
+        for query, future in self.futures.items():
+            if future.done():
+                continue
+
+            if self.snapshot is not None:
+                rows = self.snapshot.get(query)
+                if rows is None:
+                    future.set_exception(Error('The snapshot has no data for some of the categories. Export it with the same grids.'))
+                else:
+                    tracer.count('snapshot.hits')
+                    future.set_result(rows)
+
+                continue
+
+            rows = self.cache.get(query) if self.cache is not None and (not refresh or self.cache.offline) else None
+            if rows is None and self.week_store is not None and self.cache is not None and self.cache.offline:
+                rows = self.week_store.window(query)
+
+            if rows is not None:
+                tracer.count('cache.hits')
+                future.set_result(rows)
+            elif self.cache is not None and self.cache.offline:
+                future.set_exception(Error('Running offline, but some of the data isn\'t cached. Run once without --offline first.'))
+            else:
+                tracer.count('cache.misses')
+                pending.append(query)
+
+        # What's actually sent for each query; with a week store, that's only the weeks it's missing.
+        transports = {}
+        for query in pending:
+            if self.week_store is not None:
+                transport = StratzQuery(self.week_store.weeks_to_fetch(query), query.ranks, query.positions, query.modes)
+                tracer.count('stratz.weeks_skipped', query.take_weeks - transport.take_weeks)
+            else:
+                transport = query
+
+            transports.setdefault(transport, []).append(query)
+
+        try:
+            await asyncio.wait_for(self.fetch_all_weeks(stratz_client, transports), None if deadline is None else max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            tracer.count('stratz.deadline_exceeded')
+            for query in pending:
+                if not self.futures[query].done():
+                    self.fall_back(query, TimedOut('Stratz didn\'t respond before the deadline.'))
+
+        if self.cache is not None and pending:
+            self.cache.evict()
+
+    async def fetch_all_weeks(self, stratz_client, transports):
+        incomplete = await self.fetch_all(stratz_client, transports)
+        if incomplete:
+            await self.fetch_all(stratz_client, {query: [query] for query in incomplete})
+
+    def fall_back(self, query, error):
+        """
+        Resolves a query that couldn't be fetched with whatever was fetched for it before, however old.
+        """
+
+        rows = self.cache.get(query, stale=True) if self.cache is not None else None
+        if rows is None and self.week_store is not None:
+            rows = self.week_store.window(query)
+
+        if rows is None:
+            tracer.count('queries.missing')
+            self.futures[query].set_exception(error)
+        else:
+            tracer.count('queries.stale')
+            self.stale.add(query)
+            self.futures[query].set_result(rows)
+
+    async def fetch_all(self, stratz_client, transports):
+        """
+        Returns the queries which the week store still couldn't assemble after fetching only the missing weeks.
+
+        The next batch is only picked once a token from the rate limiter is in hand, so that the pick accounts for
+        everything sent before it.
+        """
+
+        incomplete = []
+        transport_queries = list(transports)
+        batches = [transport_queries[i:i + self.batch_size] for i in range(0, len(transport_queries), self.batch_size)]
+        scheduler = StratzFetchScheduler(batches, transports, self.grids)
+        fetches = []
+        try:
+            while scheduler:
+                await stratz_client.rate_limiter.acquire()
+                fetches.append(asyncio.ensure_future(self.fetch(stratz_client, scheduler.pop(), transports, incomplete)))
+
+            await asyncio.gather(*fetches)
+        finally:
+            for fetch in fetches:
+                fetch.cancel()
+
+        return incomplete
+
+    async def fetch(self, stratz_client, batch, transports, incomplete):
+        transports_by_alias = {f'query{i}': transport for i, transport in enumerate(batch)}
+        document = f'''
+            {{
+                heroStats {{{''.join([transport.selection(alias, self.week_store is not None) for alias, transport in transports_by_alias.items()])}
+                }}
+            }}
+        '''
+
+        try:
+            data, errors = await stratz_client.request(document, acquired=True)
+            tracer.count('stratz.queries', len(batch))
+            hero_stats = data.get('heroStats') if isinstance(data.get('heroStats'), dict) else {}
+            for alias, transport in transports_by_alias.items():
+                transport_rows = hero_stats.get(alias)
+                if not isinstance(transport_rows, list):
+                    # GraphQL errors only null out the fields they happened in, the rest of the batch is still good.
+                    error = Error('Stratz returned no data for some of the categories. Exact error:\n\n{}'.format(
+                        errors if errors is not None else 'The response has no data for them.'
+                    ))
+                    for query in transports[transport]:
+                        self.futures[query].set_exception(error)
+
+                    continue
+
+                if self.week_store is not None:
+                    self.week_store.merge(transport, transport_rows)
+
+                for query in transports[transport]:
+                    rows = transport_rows
+                    if self.week_store is not None:
+                        rows = self.week_store.window(query)
+                        if rows is None:
+                            if transport.take_weeks < query.take_weeks:
+                                incomplete.append(query)
+                                continue
+
+                            rows = transport_rows
+
+                    if self.cache is not None:
+                        self.cache.set(query, rows)
+
+                    self.futures[query].set_result(rows)
+        except Exception as e:
+            for transport in batch:
+                for query in transports[transport]:
+                    if not self.futures[query].done() and query not in incomplete:
+                        if isinstance(e, TimedOut):
+                            self.fall_back(query, e)
+                        else:
+                            self.futures[query].set_exception(e)
+
+
+class StratzFetchScheduler:
+    """
+    Picks which batch to send next. Every grid gets a share of the requests in proportion to its weight: its
+    `priority`, times the number of its users, times how close it is to completion (all of its queries over those
+    still unsent). Grids take turns by how much of their share they've already had, so that grids with many users, or
+    nearly done, land first, but every grid keeps making progress. Each batch goes to the grids that wait on it most.
+    """
+
+    def __init__(self, batches, transports, grids):
+        self.batches = dict(enumerate(batches))
+        self.batch_queries = {
+            i: {query for transport in batch for query in transports[transport]}
+            for i, batch in self.batches.items()
+        }
+
+        self.queries = {}
+        self.totals = {}
+        self.remaining = {}
+        self.grid_batches = {}
+        self.batch_grids = collections.defaultdict(list)
+        self.passes = {}
+        for hero_grid, queries in grids.items():
+            grid_batches = {i for i, batch_queries in self.batch_queries.items() if not batch_queries.isdisjoint(queries)}
+            if not grid_batches:
+                continue
+
+            self.queries[hero_grid] = queries
+            self.totals[hero_grid] = len(queries)
+            self.remaining[hero_grid] = sum(len(self.batch_queries[i] & queries) for i in grid_batches)
+            self.grid_batches[hero_grid] = grid_batches
+            self.passes[hero_grid] = 0
+            for i in grid_batches:
+                self.batch_grids[i].append(hero_grid)
+
+    def __bool__(self):
+        return bool(self.batches)
+
+    def weight(self, hero_grid):
+        return hero_grid.priority * len(hero_grid.users) * self.totals[hero_grid] / self.remaining[hero_grid]
+
+    def pop(self):
+        waiting = [hero_grid for hero_grid, grid_batches in self.grid_batches.items() if grid_batches]
+        if not waiting:
+            return self.batches.pop(next(iter(self.batches)))
+
+        hero_grid = min(waiting, key=lambda hero_grid: (self.passes[hero_grid], -self.weight(hero_grid)))
+        i = max(self.grid_batches[hero_grid], key=lambda i: (sum(self.weight(batch_grid) for batch_grid in self.batch_grids[i]), -i))
+
+        for batch_grid in self.batch_grids[i]:
+            self.passes[batch_grid] += 1 / self.weight(batch_grid)
+            self.remaining[batch_grid] -= len(self.batch_queries[i] & self.queries[batch_grid])
+            self.grid_batches[batch_grid].discard(i)
+
+        return self.batches.pop(i)
+
+
+class HeroStats:
+    __slots__ = ('hero_id', 'match_count', 'win_count', 'pick_rate', 'win_rate')
+
+    def __init__(self, hero_id, match_count, win_count):
+        self.hero_id = hero_id
+        self.match_count = match_count
+        self.win_count = win_count
+        self.pick_rate = 0
+        self.win_rate = 0
+
+
+class HeroStatsTable:
+    """
+    Per-hero totals of `winWeek` rows, merged in a single pass.
+    Heroes keep the order in which they first appear in the rows.
+    """
+
+    def __init__(self, rows):
+        heroes = {}
+        for row in rows:
+            hero = heroes.get(row['heroId'])
+            if hero is None:
+                heroes[row['heroId']] = HeroStats(row['heroId'], row['matchCount'], row['winCount'])
+            else:
+                hero.match_count += row['matchCount']
+                hero.win_count += row['winCount']
+
+        self.heroes = list(heroes.values())
+        self.sorted_heroes = {}
+
+        all_match_count = sum(hero.match_count for hero in self.heroes)
+
+        for hero in self.heroes:
+            hero.pick_rate = round(hero.match_count / (all_match_count / 10) * 100, 2)
+            hero.win_rate = round(hero.win_count / hero.match_count * 100, 2)
+
+    def __iter__(self):
+        return iter(self.heroes)
+
+    def __len__(self):
+        return len(self.heroes)
+
+    def sorted(self, sort_by):
+        if sort_by not in self.sorted_heroes:
+            if sort_by == 'pick_rate':
+                key = lambda hero: hero.pick_rate
+            else:
+                key = lambda hero: hero.win_rate
+
+            self.sorted_heroes[sort_by] = sorted(self.heroes, key=key, reverse=True)
+
+        return self.sorted_heroes[sort_by]
+
+
 GRID_WIDTH = 1200
 
 
+STRATZ_WEEK = 7 * 24 * 60 * 60
+STRATZ_WEEK_ROLLOVER_DELAY = 60 * 60
+DAEMON_POLL_INTERVAL = 5
+
+
+HERO_WIDTH = 95
+HERO_REAL_WIDTH = 85
+HERO_HEIGHT = 135
+HERO_REAL_HEIGHT = 170
+PICKRATE_HEIGHT = 20
+CATEGORY_SPACING = 60
+
+LAYOUT_CACHE_SIZE = 4096
+
+
+def layout_heroes(entries, heroes, show_pickrates, x_position, y_position, start_x_position=0, end_x_position=GRID_WIDTH):
+    """
+    Appends grid entries for `heroes`, left to right and wrapping between the start and end x positions, starting at
+    the given position. Returns the position after the last hero.
+    """
+
+    row_height = HERO_REAL_HEIGHT + PICKRATE_HEIGHT if show_pickrates else HERO_REAL_HEIGHT
+    for hero_id, win_rate, pick_rate in heroes:
+        if show_pickrates:
+            entries.append({
+                'category_name': '  {:.2f}%'.format(win_rate),
+                'x_position': x_position,
+                'y_position': y_position,
+                'width': 0,
+                'height': 0,
+                'hero_ids': []
+            })
+
+            entries.append({
+                'category_name': '  {:.2f}%'.format(pick_rate),
+                'x_position': x_position,
+                'y_position': y_position + PICKRATE_HEIGHT,
+                'width': HERO_WIDTH,
+                'height': HERO_HEIGHT,
+                'hero_ids': [
+                    hero_id
+                ]
+            })
+        else:
+            entries.append({
+                'category_name': '  {:.2f}%'.format(win_rate),
+                'x_position': x_position,
+                'y_position': y_position,
+                'width': HERO_WIDTH,
+                'height': HERO_HEIGHT,
+                'hero_ids': [
+                    hero_id
+                ]
+            })
+
+        if x_position + HERO_REAL_WIDTH * 2 > end_x_position:
+            x_position = start_x_position
+            y_position += row_height
+        else:
+            x_position += HERO_REAL_WIDTH
+
+    return x_position, y_position
+
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def layout_category(name, heroes, outliers, show_pickrates):
+    """
+    Lays out a category as if it were at the top of the grid: its name, its heroes, and its outliers in their own
+    section below them. Heroes and outliers are tuples of (hero ID, winrate, pickrate), in display order.
+
+    Returns a tuple of grid entries and the category's height. Results are memoized on the arguments, so identical
+    categories, wherever they are in whichever grid, and across runs in daemon mode, are laid out once. The entries
+    are shared because of that, and mustn't be modified.
+    """
+
+    entries = [{
+        'category_name': name,
+        'x_position': 0,
+        'y_position': 0,
+        'width': 0,
+        'height': 0,
+        'hero_ids': []
+    }]
+
+    row_height = HERO_REAL_HEIGHT + PICKRATE_HEIGHT if show_pickrates else HERO_REAL_HEIGHT
+    x_position, y_position = layout_heroes(entries, heroes, show_pickrates, 0, HERO_REAL_HEIGHT - HERO_HEIGHT)
+
+    if outliers:
+        if x_position != 0:
+            y_position += row_height
+
+        entries.append({
+            'category_name': f'Outliers: {name}',
+            'x_position': HERO_REAL_WIDTH,
+            'y_position': y_position,
+            'width': 0,
+            'height': 0,
+            'hero_ids': []
+        })
+
+        y_position += HERO_REAL_HEIGHT - HERO_HEIGHT
+        x_position, y_position = layout_heroes(entries, outliers, show_pickrates, HERO_REAL_WIDTH, y_position, HERO_REAL_WIDTH, GRID_WIDTH - HERO_REAL_WIDTH)
+
+        if x_position == HERO_REAL_WIDTH:
+            x_position = 0
+
+    height = y_position
+    if x_position != 0:
+        height += row_height
+
+    return tuple(entries), height
+
+
+def layout_grid(categories):
+    """
+    Lays out categories one below another in a single pass, each given as the arguments of `layout_category`.
+    Returns the grid entries, moved down to where their categories are.
+    """
+
+    entries = []
+    y_offset = 0
+    for name, heroes, outliers, show_pickrates in categories:
+        category_entries, height = layout_category(name, heroes, outliers, show_pickrates)
+        if y_offset == 0:
+            entries.extend(category_entries)
+        else:
+            entries.extend(dict(entry, y_position=entry['y_position'] + y_offset) for entry in category_entries)
+
+        y_offset += height + CATEGORY_SPACING
+
+    return entries
+
+
 class HeroGridCategory:
-    HERO_WIDTH = 95
-    HERO_REAL_WIDTH = 85
-    HERO_HEIGHT = 135
-    HERO_REAL_HEIGHT = 170
+    # Heroes picked for categories so far, keyed by their options and a digest of their data, so that identical
+    # categories (across grids, or across runs in daemon mode) are only picked once.
+    BUILT_CACHE_SIZE = 4096
+    built = collections.OrderedDict()
 
     def __init__(
         self,
@@ -57,8 +1270,7 @@ class HeroGridCategory:
         winrate_outlier_treshold,
         pickrate_outlier_treshold,
         take_weeks,
-        stratz_token,
-        http_session
+        query_planner
     ):
         self.name = name
         self.positions = positions
@@ -73,210 +1285,65 @@ class HeroGridCategory:
         self.winrate_outlier_treshold = winrate_outlier_treshold
         self.pickrate_outlier_treshold = pickrate_outlier_treshold
         self.take_weeks = take_weeks
-        self.data = [{
-            'category_name': name,
-            'x_position': 0,
-            'y_position': 0,
-            'width': 0,
-            'height': 0,
-            'hero_ids': []
-        }]
-        self.stratz_token = stratz_token
-        self.http_session = http_session
-        self.real_height = 0
-
-    @classmethod
-    async def create(cls, *args, **kwargs):
-        inst = cls(*args, **kwargs)
-
-        query = f'''
-            {{
-                heroStats {{
-                    winWeek(
-                        take: {inst.take_weeks},
-                        bracketIds: [{','.join([rank.upper() for rank in inst.ranks])}],
-                        positionIds: [{','.join([f'POSITION_{position}' for position in inst.positions])}],
-                        gameModeIds: [{','.join([mode.upper() for mode in inst.modes])}]
-                    ) {{
-                        heroId,
-                        matchCount,
-                        winCount
-                    }}
-                }}
-            }}
-        '''
-
-        async def make_request(api):
-            while True:
-                inst.http_session.rate_limiting['requests'] = [request for request in inst.http_session.rate_limiting['requests'] if request['timestamp'] >= time.time() - 1]
-                if len(inst.http_session.rate_limiting['requests']) < inst.http_session.rate_limiting['requests_per_second']:
-                    break
-
-                await asyncio.sleep(0.5)
-
-            id = uuid.uuid4()
-            inst.http_session.rate_limiting['requests'].append({
-                'id': id,
-                'timestamp': time.time()
-            })
-            resp = await inst.http_session.post(
-                f'{api}',
-                data=json.dumps({'query': query}),
-                headers = {
-                    'User-Agent': 'STRATZ_API',
-                    'Authorization': f'Bearer {inst.stratz_token}',
-                    'Content-Type': 'application/json'
-                }
-            )
-
-            inst.http_session.rate_limiting['requests'] = [request for request in inst.http_session.rate_limiting['requests'] if request['id'].int != id.int]
-
-            text = await resp.text()
-
-            try:
-                json_data = json.loads(text)
-
-                try:
-                    if json_data['message'] == 'API rate limit exceeded':
-                        print('You\'re being rate-limited by Stratz. Lower requests_per_second in the configuration file.\n\n')
-                        os._exit()
-                    elif json_data['message'] == 'A bearer token is required for a request. View more at https://stratz.com/api':
-                        print('Your Stratz API token has expired. Refresh it at https://stratz.com/api.\n\n')
-                        os._exit()
-                except:
-                    pass
-
-                return json.loads(text)['data']
-            except Exception as e:
-                raise Error(f'Failed to parse data from Stratz. The API may be down, your connection unstable, '
-                            f'or something else. Exact error:\n\n{traceback.format_exc()}\n\nData:{text}')
-
-        data = (await make_request('https://api.stratz.com/graphql'))
-
-        heroes_raw = data['heroStats']['winWeek']
-        heroes = []
-        for hero in heroes_raw:
-            if any([hero['heroId'] == h['heroId'] for h in heroes]):
-                continue
-
-            for h in [h for h in heroes_raw if hero['heroId'] == h['heroId']][1:]:
-                hero['winCount'] += h['winCount']
-                hero['matchCount'] += h['matchCount']
-
-            heroes.append(hero)
-
-        all_match_count = sum([hero['matchCount'] for hero in heroes])
-
-        for hero in heroes:
-            hero['pickRate'] = round(hero['matchCount'] / (all_match_count / 10) * 100, 2)
-            hero['winRate'] = round(hero['winCount'] / hero['matchCount'] * 100, 2)
-
-        x_position = 0
-        y_position = inst.HERO_REAL_HEIGHT - inst.HERO_HEIGHT
-        def generate_hero(hero, start_x_position=None, end_x_position=None):
-            nonlocal inst
-            nonlocal x_position
-            nonlocal y_position
-
-            if start_x_position is None:
-                start_x_position = 0
-
-            if end_x_position is None:
-                end_x_position = 1200
-
-            if inst.show_pickrates:
-                inst.data.append({
-                    'category_name': '  {:.2f}%'.format(hero['winRate']),
-                    'x_position': x_position,
-                    'y_position': y_position,
-                    'width': 0,
-                    'height': 0,
-                    'hero_ids': []
-                })
-
-                inst.data.append({
-                    'category_name': '  {:.2f}%'.format(hero['pickRate']),
-                    'x_position': x_position,
-                    'y_position': y_position + 20,
-                    'width': inst.HERO_WIDTH,
-                    'height': inst.HERO_HEIGHT,
-                    'hero_ids': [
-                        hero['heroId']
-                    ]
-                })
-
-                if x_position + inst.HERO_REAL_WIDTH * 2 > end_x_position:
-                    x_position = start_x_position
-                    y_position += inst.HERO_REAL_HEIGHT + 20
-                else:
-                    x_position += inst.HERO_REAL_WIDTH
-            else:
-                inst.data.append({
-                    'category_name': '  {:.2f}%'.format(hero['winRate']),
-                    'x_position': x_position,
-                    'y_position': y_position,
-                    'width': inst.HERO_WIDTH,
-                    'height': inst.HERO_HEIGHT,
-                    'hero_ids': [
-                        hero['heroId']
-                    ]
-                })
-
-                if x_position + inst.HERO_REAL_WIDTH * 2 > end_x_position:
-                    x_position = start_x_position
-                    y_position += inst.HERO_REAL_HEIGHT
-                else:
-                    x_position += inst.HERO_REAL_WIDTH
-
-        winrate_outlier_treshold = inst.winrate_outlier_treshold if inst.winrate_outlier_treshold is not None else 1000
-        pickrate_outlier_treshold = inst.pickrate_outlier_treshold if inst.pickrate_outlier_treshold is not None else 1000
-
-        sort_key = lambda hero: hero['pickRate'] if inst.sort_by == 'pick_rate' else hero['winRate']
+        self.heroes = ()
+        self.outliers = ()
+        self.query_planner = query_planner
+        self.query = query_planner.add(StratzQuery(take_weeks, ranks, positions, modes))
+
+    @property
+    def options(self):
+        return (
+            self.name,
+            self.sort_by,
+            self.winrate_treshold,
+            self.pickrate_treshold,
+            self.show_pickrates,
+            self.include_outliers,
+            self.show_outliers_separately,
+            self.winrate_outlier_treshold,
+            self.pickrate_outlier_treshold
+        )
+
+    async def build(self):
+        """
+        Picks the heroes to show, and the outliers to show separately, in display order, as (hero ID, winrate,
+        pickrate) tuples. Laying them out is up to `layout_category`.
+        """
+
+        key = (self.options, self.query.key, await self.query_planner.digest(self.query))
+        if key in self.built:
+            tracer.count('categories.reused')
+            self.built.move_to_end(key)
+            self.heroes, self.outliers = self.built[key]
+            return
+
+        heroes = await self.query_planner.table(self.query)
+        with tracer.span('category.build', category=self.name, heroes=len(heroes)):
+            self.heroes, self.outliers = self.pick(heroes)
+
+        self.built[key] = (self.heroes, self.outliers)
+        if len(self.built) > self.BUILT_CACHE_SIZE:
+            self.built.popitem(last=False)
+
+    def pick(self, heroes):
+        winrate_outlier_treshold = self.winrate_outlier_treshold if self.winrate_outlier_treshold is not None else 1000
+        pickrate_outlier_treshold = self.pickrate_outlier_treshold if self.pickrate_outlier_treshold is not None else 1000
 
         category_heroes = []
-        for hero in sorted(heroes, key=sort_key, reverse=True):
-            if (hero['winRate'] >= inst.winrate_treshold and hero['pickRate'] >= inst.pickrate_treshold) or (inst.include_outliers and not inst.show_outliers_separately and (hero['winRate'] >= winrate_outlier_treshold or hero['pickRate'] >= pickrate_outlier_treshold)):
-                generate_hero(hero)
+        category_hero_ids = set()
+        for hero in heroes.sorted(self.sort_by):
+            if (hero.win_rate >= self.winrate_treshold and hero.pick_rate >= self.pickrate_treshold) or (self.include_outliers and not self.show_outliers_separately and (hero.win_rate >= winrate_outlier_treshold or hero.pick_rate >= pickrate_outlier_treshold)):
                 category_heroes.append(hero)
+                category_hero_ids.add(hero.hero_id)
 
-        if inst.include_outliers and inst.show_outliers_separately:
-            outliers = [h for h in heroes if not any(ch['heroId'] == h['heroId'] for ch in category_heroes) and (h['winRate'] >= winrate_outlier_treshold or h['pickRate'] >= pickrate_outlier_treshold)]
-
-            if len(outliers) > 0:
-                if x_position != 0:
-                    y_position += inst.HERO_REAL_HEIGHT
-
-                    if inst.show_pickrates:
-                        y_position += 20
-
-                x_position = inst.HERO_REAL_WIDTH
-
-                inst.data.append({
-                    'category_name': f'Outliers: {inst.name}',
-                    'x_position': x_position,
-                    'y_position': y_position,
-                    'width': 0,
-                    'height': 0,
-                    'hero_ids': []
-                })
-
-                y_position += inst.HERO_REAL_HEIGHT - inst.HERO_HEIGHT
+        outliers = []
+        if self.include_outliers and self.show_outliers_separately:
+            outliers = [h for h in heroes.sorted(self.sort_by) if h.hero_id not in category_hero_ids and (h.win_rate >= winrate_outlier_treshold or h.pick_rate >= pickrate_outlier_treshold)]
 
-                for hero in sorted(outliers, key=sort_key, reverse=True):
-                    generate_hero(hero, inst.HERO_REAL_WIDTH, 1200 - inst.HERO_REAL_WIDTH)
-
-                if x_position == inst.HERO_REAL_WIDTH:
-                    x_position = 0
-
-        if x_position == 0:
-            inst.real_height += y_position
-        else:
-            inst.real_height += y_position + inst.HERO_REAL_HEIGHT
-
-            if inst.show_pickrates:
-                inst.real_height += 20
-
-        return inst
+        return (
+            tuple((hero.hero_id, hero.win_rate, hero.pick_rate) for hero in category_heroes),
+            tuple((hero.hero_id, hero.win_rate, hero.pick_rate) for hero in outliers)
+        )
 
 
 class HeroGrid:
@@ -296,12 +1363,19 @@ class HeroGrid:
         winrate_outlier_treshold,
         pickrate_outlier_treshold,
         take_weeks,
-        stratz_token,
-        http_session
+        priority,
+        query_planner
     ):
         self.name = name
         self.users = users
 
+        if priority is None:
+            self.priority = 1
+        elif priority > 0:
+            self.priority = priority
+        else:
+            raise Error(f'The priority of {name} has to be above 0.')
+
         if categories is None:
             self.categories = [
                 {
@@ -394,18 +1468,14 @@ class HeroGrid:
             'config_name': self.name,
             'categories': []
         }
+        self.serialized = {}
+        self.digest = None
+        self.stale_categories = []
+        self.missing_categories = []
 
-        self.stratz_token = stratz_token
-        
-        self.http_session = http_session
-
-    @classmethod
-    async def create(cls, *args, **kwargs):
-        inst = cls(*args, **kwargs)
-
-        categories_coros = []
-        for category in inst.categories:
-            categories_coros.append(HeroGridCategory.create(
+        self.hero_grid_categories = []
+        for category in self.categories:
+            self.hero_grid_categories.append(HeroGridCategory(
                 category['name'],
                 category['positions'],
                 category['ranks'],
@@ -419,22 +1489,87 @@ class HeroGrid:
                 category['winrate_outlier_treshold'],
                 category['pickrate_outlier_treshold'],
                 category['weeks'],
-                inst.stratz_token,
-                inst.http_session
+                query_planner
             ))
 
-        categories = await asyncio.gather(*categories_coros)
+        query_planner.register(self)
+
+    async def build(self):
+        """
+        Categories which timed out without any older data to fall back to are left out. The grid fails only if
+        all of them are.
+        """
+
+        categories = []
+        errors = []
+        for category, result in zip(self.hero_grid_categories, await asyncio.gather(*[category.build() for category in self.hero_grid_categories], return_exceptions=True)):
+            if isinstance(result, TimedOut):
+                self.missing_categories.append(category.name)
+                errors.append(result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                categories.append(category)
+                if category.query_planner.is_stale(category.query):
+                    self.stale_categories.append(category.name)
+
+        if not categories:
+            raise errors[0]
+
+        with tracer.span('grid.layout', grid=self.name):
+            self.data['categories'] = layout_grid(
+                (category.name, category.heroes, category.outliers, category.show_pickrates) for category in categories
+            )
+
+        self.digest = content_digest(self.serialize(True))
+
+    def serialize(self, compact, depth=0):
+        if (compact, depth) not in self.serialized:
+            self.serialized[(compact, depth)] = serialize_json(self.data, compact, depth)
+
+        return self.serialized[(compact, depth)]
+
+    def release(self):
+        """
+        Drops everything but the grid's serializations, once it's been handed to all of its users.
+        """
+
+        self.data = None
+        self.hero_grid_categories = None
+
+
+class PulledHeroGrid:
+    """
+    A grid pulled from a generator running with --serve, with just enough of HeroGrid to be added to a config.
+    """
+
+    def __init__(self, data):
+        self.name = data['config_name']
+        self.data = data
+        self.serialized = {}
+        self.digest = content_digest(self.serialize(True))
 
-        cumulated_height = 0
-        for i, category in enumerate(categories):
-            if i > 0:
-                for subcategory in category.data:
-                    subcategory['y_position'] += cumulated_height
+    def serialize(self, compact, depth=0):
+        if (compact, depth) not in self.serialized:
+            self.serialized[(compact, depth)] = serialize_json(self.data, compact, depth)
 
-            inst.data['categories'].extend(category.data)
-            cumulated_height += category.real_height + 60
+        return self.serialized[(compact, depth)]
 
-        return inst
+
+def serialize_json(data, compact, depth=0):
+    """
+    Serializes `data` exactly as it would appear nested `depth` levels deep inside a larger document,
+    so that pre-serialized pieces can be spliced together without serializing them again.
+    """
+
+    if compact:
+        return json_dumps(data)
+
+    return json.dumps(data, indent=4).replace('\n', '\n' + ' ' * 4 * depth)
+
+
+def content_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
 
 class HeroGridsConfig:
@@ -444,9 +1579,10 @@ class HeroGridsConfig:
     DOTA2_CFG_FOLDER_NAME = 'cfg'
     GRID_CONFIG_FILE_NAME = 'hero_grid_config.json'
 
-    def __init__(self, steam_path, user):
+    def __init__(self, steam_path, user, compact=False):
         self.steam_path = steam_path
         self.user = user
+        self.compact = compact
         self.path = \
             Path(self.steam_path) / \
             self.STEAM_USERDATA_FOLDER_NAME / \
@@ -457,80 +1593,355 @@ class HeroGridsConfig:
             self.GRID_CONFIG_FILE_NAME
 
         try:
-            with open(self.path, 'r', encoding='utf-8') as fp:
-                self.data = json.load(fp)
+            with open(self.path, 'rb') as fp:
+                self.data = json_loads(fp.read())
+
+            self.changed = False
         except:
             self.data = {
                 'version': 3,
                 'configs': []
             }
 
-    def add(self, new_grid):
+            self.changed = True
+
+        self.grids_by_data_id = {}
+        self.appended = []
+
+    def add(self, new_grid, position=None):
+        """
+        Only a placeholder goes into the config's data, the grid itself is spliced in from its serialization when
+        saving, so the grid's data can be let go of as soon as it's been added everywhere.
+
+        Grids that are new to the config go after the existing ones, ordered by `position` among themselves,
+        whatever order they're added in.
+        """
+
+        placeholder = {'config_name': new_grid.name}
         replaced = False
         for i, grid in enumerate(self.data['configs']):
             if grid['config_name'] == new_grid.name:
-                self.data['configs'][i] = new_grid.data
+                if id(grid) in self.grids_by_data_id:
+                    self.grids_by_data_id.pop(id(grid))
+                    self.data['configs'][i] = placeholder
+                elif content_digest(serialize_json(grid, True)) != new_grid.digest:
+                    self.data['configs'][i] = placeholder
+                    self.changed = True
+                else:
+                    return
+
                 replaced = True
                 break
 
         if not replaced:
-            self.data['configs'].append(new_grid.data)
+            index = len(self.data['configs'])
+            if position is not None:
+                later_names = [name for appended_position, name in self.appended if appended_position > position]
+                if later_names:
+                    index = min(i for i, grid in enumerate(self.data['configs']) if grid['config_name'] in later_names)
+
+            self.data['configs'].insert(index, placeholder)
+            self.appended.append((position if position is not None else float('inf'), new_grid.name))
+            self.changed = True
+
+        self.grids_by_data_id[id(placeholder)] = new_grid
+
+    def serialize(self):
+        """
+        Grids added to this config are spliced in from their own serialization, which is shared by every user
+        who gets the same grid.
+        """
+
+        configs = []
+        for grid in self.data['configs']:
+            if id(grid) in self.grids_by_data_id:
+                configs.append(self.grids_by_data_id[id(grid)].serialize(self.compact, 2))
+            else:
+                configs.append(serialize_json(grid, self.compact, 2))
+
+        fields = []
+        for key, value in self.data.items():
+            if key == 'configs':
+                if self.compact:
+                    value = '[{}]'.format(','.join(configs))
+                elif configs:
+                    value = '[\n        {}\n    ]'.format(',\n        '.join(configs))
+                else:
+                    value = '[]'
+            else:
+                value = serialize_json(value, self.compact, 1)
+
+            fields.append((json.dumps(key), value))
+
+        if self.compact:
+            return '{{{}}}'.format(','.join(f'{key}:{value}' for key, value in fields))
+
+        return '{{\n{}\n}}'.format(',\n'.join(f'    {key}: {value}' for key, value in fields))
 
     def save(self):
-        with open(self.path, 'w', encoding='utf-8') as fp:
-            json.dump(self.data, fp, indent=4)
+        """
+        Writes the config through a temporary file, so that Dota never sees a half-written one.
+        Returns False without touching the disk if none of the grids changed.
+        """
+
+        if not self.changed:
+            tracer.count('configs.unchanged')
+            return False
+
+        with tracer.span('config.save', user=self.user.account_name):
+            temp_path = self.path.with_name(self.path.name + '.tmp')
+            with open(temp_path, 'w', encoding='utf-8') as fp:
+                fp.write(self.serialize())
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            os.replace(temp_path, self.path)
+
+        self.changed = False
+        return True
+
+
+class HeroGridsWriter:
+    """
+    Adds built grids to the configs of their users, and saves each config as soon as all of the grids expected for
+    it are in. Every user's config is read once, in the background, however many grids or config files it gets.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.targets = {}
+        self.expected = collections.Counter()
+        self.pending = collections.Counter()
+        self.loading = {}
+        self.added = set()
+
+    def expect(self, hero_grids, steam_users, compact=False):
+        for hero_grid in hero_grids:
+            keys = self.targets.setdefault(hero_grid, [])
+            for steam_path, user in steam_users:
+                if user.account_name in hero_grid.users:
+                    key = (str(steam_path), user.id3)
+                    self.users.setdefault(key, (steam_path, user, compact))
+                    keys.append((key, self.expected[key]))
+                    self.expected[key] += 1
+                    self.pending[key] += 1
+
+    def load(self):
+        """
+        Starts reading the configs, so that it happens while the data is being fetched.
+        """
+
+        for key, (steam_path, user, compact) in self.users.items():
+            if key not in self.loading:
+                self.loading[key] = asyncio.ensure_future(self._load(steam_path, user, compact))
+
+    async def _load(self, steam_path, user, compact):
+        with tracer.span('config.load', user=user.account_name):
+            return await asyncio.to_thread(HeroGridsConfig, steam_path, user, compact)
+
+    async def add(self, hero_grid):
+        saves = []
+        for key, position in self.targets.pop(hero_grid):
+            hero_grids_config = await self.loading[key]
+            hero_grid.serialize(hero_grids_config.compact, 2)
+            hero_grids_config.add(hero_grid, position)
+            self.added.add(key)
+            self.pending[key] -= 1
+            if self.pending[key] == 0:
+                saves.append(asyncio.to_thread(hero_grids_config.save))
+
+        hero_grid.release()
+        await asyncio.gather(*saves)
+
+    async def skip(self, hero_grid):
+        """
+        Gives up on a grid that failed to build, so that it doesn't hold back the other grids of its users.
+        """
+
+        saves = []
+        for key, _ in self.targets.pop(hero_grid):
+            self.pending[key] -= 1
+            if self.pending[key] == 0 and key in self.added:
+                saves.append(asyncio.to_thread((await self.loading[key]).save))
+
+        await asyncio.gather(*saves)
+
+    async def close(self):
+        await asyncio.gather(*self.loading.values(), return_exceptions=True)
+
+
+def load_steam_users(steam_path):
+    """
+    Parses the Steam users of an installation, only re-reading `loginusers.vdf` once it changes.
+    """
+
+    path = Path(steam_path) / STEAM_CONFIG_FOLDER_NAME / STEAM_USERS_FILE_NAME
+    try:
+        return _load_steam_users(path, path.stat().st_mtime_ns)
+    except (FileNotFoundError, KeyError):
+        raise Error('Steam path invalid, or Steam config files corrupt.')
+
+
+@functools.lru_cache(maxsize=None)
+def _load_steam_users(path, mtime):
+    import vdf
+
+    with open(path, 'r', encoding='utf-8') as fp:
+        return [SteamUser(user['AccountName'], user['PersonaName'], id64) for id64, user in vdf.load(fp)['users'].items()]
+
+
+def load_config(path):
+    try:
+        with open(path, 'rb') as fp:
+            config = json_loads(fp.read())
+    except FileNotFoundError:
+        raise Error(f'Config file {path} not found.')
+    except ValueError as e:
+        raise Error(f'Config file {path} is not valid JSON: {e}')
+
+    if not isinstance(config, dict):
+        raise Error(f'Config file {path} has to contain a JSON object.')
+
+    return config
+
+
+def check_config(path, config, stratz=True):
+    """
+    Checks that the sections every run relies on are there, so that a config missing them can be left out of a batch
+    up front. Without `stratz`, the config doesn't need a `stratz` section.
+    """
 
+    sections = {'steam': dict, 'grids': list}
+    if stratz:
+        sections['stratz'] = dict
 
-async def main():
-    with open('config.json', 'r', encoding='utf-8') as fp:
-        config = json.load(fp)
+    for section, section_type in sections.items():
+        if not isinstance(config.get(section), section_type):
+            raise Error(f'Config file {path} has no valid {section} section.')
 
-    connector = aiohttp.TCPConnector(
-        family=socket.AF_INET,
-        ssl=False,
-        limit=config['stratz']['requests_per_second']
+    if 'path' not in config['steam']:
+        raise Error(f'Config file {path} has no steam.path.')
+
+    if stratz:
+        if not isinstance(config['stratz'].get('token'), str):
+            raise Error(f'Config file {path} has no stratz.token.')
+
+        if not isinstance(config['stratz'].get('requests_per_second'), (int, float)):
+            raise Error(f'Config file {path} has no valid stratz.requests_per_second.')
+
+
+def invalid_config_error(path, e):
+    return Error(f'{path} has a missing or invalid option, check it against the config documentation. '
+                 f'Exact error: {type(e).__name__}: {e}')
+
+
+def create_query_planner(config, cache, snapshot=None):
+    if snapshot is not None:
+        return StratzQueryPlanner(split_positions=snapshot.split_positions, split_ranks=snapshot.split_ranks, snapshot=snapshot)
+
+    return StratzQueryPlanner(
+        config['stratz'].get('batch_size', 1),
+        cache,
+        config['stratz'].get('split_positions', False),
+        config['stratz'].get('split_ranks', False),
+        StratzWeekStore(cache.path / 'weeks') if config.get('cache', {}).get('incremental', False) else None
     )
 
-    cookie_jar = aiohttp.CookieJar(unsafe=True)
 
-    async with aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar) as http_session:
-        http_session.rate_limiting = {
-            'requests_per_second': config['stratz']['requests_per_second'],
-            'requests': []
-        }
+def plan_grids(config, query_planner, log=print):
+    """
+    Validates the grids and users in the config, and registers the grids' queries with the planner.
+    Returns the grids, (Steam path, user) pairs to write them for, and the matched users by account name.
+    """
+
+    hero_grids = create_hero_grids(config, query_planner, log)
+    return (hero_grids, *match_steam_users(config, hero_grids, log))
+
+
+VARIANT_OPTIONS = (
+    'sort_by',
+    'winrate_treshold',
+    'pickrate_treshold',
+    'show_pickrates',
+    'include_outliers',
+    'show_outliers_separately',
+    'winrate_outlier_treshold',
+    'pickrate_outlier_treshold'
+)
+
+
+def expand_variants(grid):
+    """
+    Expands a grid with `variants` into a grid for every combination of the option values listed there. Variants
+    only differ in how heroes are picked and laid out, so they all share the same data.
+    """
+
+    variants = grid.get('variants')
+    if variants is None:
+        return [grid]
+
+    if not isinstance(variants, dict):
+        raise Error('Variants of {} have to be an object of option values.'.format(grid['name']))
+
+    name_format = variants.get('name')
+    options = {option: values for option, values in variants.items() if option != 'name'}
+
+    unknown_options = [option for option in options if option not in VARIANT_OPTIONS]
+    if unknown_options:
+        raise Error('Variants of {} can only vary {}, not {}.'.format(grid['name'], ', '.join(VARIANT_OPTIONS), ', '.join(unknown_options)))
+
+    not_lists = [option for option, values in options.items() if not isinstance(values, list) or not values]
+    if not_lists:
+        raise Error('Variants of {} need a non-empty list of values for {}.'.format(grid['name'], ', '.join(not_lists)))
+
+    grids = []
+    for values in itertools.product(*options.values()):
+        variant = dict(zip(options, values))
+
+        variant_grid = {option: value for option, value in grid.items() if option != 'variants'}
+        variant_grid.update(variant)
+
+        # Grids fill in their categories' options, so every variant needs its own copies.
+        if grid.get('categories') is not None:
+            variant_grid['categories'] = [dict(category) for category in grid['categories']]
+
+        if name_format is None:
+            variant_grid['name'] = '{} ({})'.format(grid['name'], ', '.join(f'{option} {value}' for option, value in variant.items()))
+        else:
+            try:
+                variant_grid['name'] = name_format.format(name=grid['name'], **variant)
+            except (KeyError, IndexError, ValueError) as e:
+                raise Error('The name of the variants of {} isn\'t a valid template: {}'.format(grid['name'], e))
+
+        grids.append(variant_grid)
+
+    # Grids are told apart by name, so variants with the same name would overwrite each other.
+    names = collections.Counter(variant_grid['name'] for variant_grid in grids)
+    duplicate_names = [name for name, count in names.items() if count > 1]
+    if duplicate_names:
+        raise Error('Variants of {} have to have different names, but some are named {}.'.format(grid['name'], ', '.join(duplicate_names)))
+
+    return grids
+
+
+def expand_grids(config):
+    return list(itertools.chain.from_iterable(expand_variants(grid) for grid in config['grids']))
 
-        hero_grid_coros = []
-        for grid in config['grids']:
-            hero_grid_coros.append(HeroGrid.create(
-                grid['name'],
-                grid['users'],
-                grid.get('categories'),
-                grid.get('ranks'),
-                grid.get('modes'),
-                grid.get('sort_by'),
-                grid.get('winrate_treshold'),
-                grid.get('pickrate_treshold'),
-                grid.get('show_pickrates'),
-                grid.get('include_outliers'),
-                grid.get('show_outliers_separately'),
-                grid.get('winrate_outlier_treshold'),
-                grid.get('pickrate_outlier_treshold'),
-                grid.get('weeks'),
-                config['stratz']['token'],
-                http_session
-            ))
 
-        hero_grids = await asyncio.gather(*hero_grid_coros)
+def create_hero_grids(config, query_planner, log=print):
+    """
+    Creates the grids which have users, registering their queries with the planner.
+    """
 
     grids = []
     grids_without_users = []
     grid_user_names = set()
-    for hero_grid in hero_grids:
-        if not hero_grid.users:
-            grids_without_users.append(hero_grid.name)
+    for grid in expand_grids(config):
+        if not grid['users']:
+            grids_without_users.append(grid['name'])
         else:
-            grids.append(hero_grid)
-            grid_user_names = grid_user_names.union(hero_grid.users)
+            grids.append(grid)
+            grid_user_names = grid_user_names.union(grid['users'])
 
     if not grids:
         raise Error('No grids found in the config!')
@@ -539,56 +1950,606 @@ async def main():
         raise Error('None of the grids are assigned to any users!')
 
     if grids_without_users:
-        print('Warning: These grids have no users: {}.'.format(', '.join(grids_without_users)))
+        log('Warning: These grids have no users: {}.'.format(', '.join(grids_without_users)))
+
+    hero_grids = []
+    for grid in grids:
+        hero_grids.append(HeroGrid(
+            grid['name'],
+            grid['users'],
+            grid.get('categories'),
+            grid.get('ranks'),
+            grid.get('modes'),
+            grid.get('sort_by'),
+            grid.get('winrate_treshold'),
+            grid.get('pickrate_treshold'),
+            grid.get('show_pickrates'),
+            grid.get('include_outliers'),
+            grid.get('show_outliers_separately'),
+            grid.get('winrate_outlier_treshold'),
+            grid.get('pickrate_outlier_treshold'),
+            grid.get('weeks'),
+            grid.get('priority'),
+            query_planner
+        ))
+
+    return hero_grids
+
+
+def get_steam_paths(config):
+    steam_paths = config['steam']['path']
+    if isinstance(steam_paths, str):
+        steam_paths = [steam_paths]
+
+    return steam_paths
+
+
+def match_steam_users(config, hero_grids, log=print):
+    """
+    Returns (Steam path, user) pairs of the grids' users, and the matched users by account name.
+    """
+
+    grid_user_names = set()
+    for hero_grid in hero_grids:
+        grid_user_names = grid_user_names.union(hero_grid.users)
 
     steam_users = []
     steam_users_by_account_name = {}
-    try:
-        with open(Path(config['steam']['path']) / STEAM_CONFIG_FOLDER_NAME / STEAM_USERS_FILE_NAME, 'r', encoding='utf-8') as fp:
-            for id64, user in vdf.load(fp)['users'].items():
-                if user['AccountName'] in grid_user_names:
-                    grid_user_names.remove(user['AccountName'])
-                    steam_users.append(SteamUser(user['AccountName'], user['PersonaName'], id64))
-                    steam_users_by_account_name[user['AccountName']] = steam_users[-1]
-    except FileNotFoundError:
-        raise Error('Steam path invalid, or Steam config files corrupt.')
+    for steam_path in get_steam_paths(config):
+        for user in load_steam_users(steam_path):
+            if user.account_name in grid_user_names:
+                steam_users.append((steam_path, user))
+                steam_users_by_account_name.setdefault(user.account_name, user)
 
     if not steam_users:
         raise Error('Usernames from the config don\'t match to any Steam users!')
 
+    grid_user_names.difference_update(steam_users_by_account_name)
     if grid_user_names:
-        print('Warning: These usernames from the config weren\'t matched to any Steam users: {}.'.format(', '.join(grid_user_names)))
-
-    hero_grids_configs = []
-    hero_grids_configs_by_user_account_name = {}
-    for user in steam_users:
-        hero_grids_configs.append(HeroGridsConfig(config['steam']['path'], user))
-        hero_grids_configs_by_user_account_name[user.account_name] = hero_grids_configs[-1]
-    
-    for grid in grids:
-        for user in grid.users:
+        log('Warning: These usernames from the config weren\'t matched to any Steam users: {}.'.format(', '.join(grid_user_names)))
+
+    return steam_users, steam_users_by_account_name
+
+
+async def output_grids(hero_grids, steam_users_by_account_name, hero_grids_writer, log=print):
+    """
+    Hands the grids to the writer as they're built, while the planner is executing.
+    Returns the grids that were updated; those that timed out completely are reported and skipped.
+    """
+
+    async def output(hero_grid):
+        try:
+            await hero_grid.build()
+        except TimedOut as e:
+            await hero_grids_writer.skip(hero_grid)
+            log('Warning: {} wasn\'t updated. {}'.format(hero_grid.name, e.args[0]))
+            return False
+        except BaseException:
+            await hero_grids_writer.skip(hero_grid)
+            raise
+
+        await hero_grids_writer.add(hero_grid)
+
+        users = ['{} ({})'.format(user, steam_users_by_account_name[user].persona_name) for user in hero_grid.users if user in steam_users_by_account_name]
+        log('{} updated for {}.'.format(hero_grid.name, ', '.join(users)))
+
+        report_incomplete_data(hero_grid, log)
+        return True
+
+    # Every grid gets to finish before the first error is raised, so none are left running behind the caller's back.
+    results = await asyncio.gather(*[output(hero_grid) for hero_grid in hero_grids], return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    return [hero_grid for hero_grid, updated in zip(hero_grids, results) if updated]
+
+
+def report_incomplete_data(hero_grid, log=print):
+    if hero_grid.stale_categories:
+        log('Warning: {} has categories with stale data: {}.'.format(hero_grid.name, ', '.join(hero_grid.stale_categories)))
+
+    if hero_grid.missing_categories:
+        log('Warning: {} is missing categories that Stratz didn\'t respond for in time: {}.'.format(hero_grid.name, ', '.join(hero_grid.missing_categories)))
+
+
+def plural(count, noun):
+    return '{} {}{}'.format(count, noun, 's' if count != 1 else '')
+
+
+def configure_stratz_client(stratz_client, config):
+    stratz_client.token = config['stratz']['token']
+    stratz_client.timeout = config['stratz'].get('timeout', StratzClient.DEFAULT_TIMEOUT)
+    stratz_client.retries = config['stratz'].get('retries', StratzClient.DEFAULT_RETRIES)
+    stratz_client.retry_backoff = config['stratz'].get('retry_backoff', StratzClient.DEFAULT_RETRY_BACKOFF)
+    stratz_client.hedge_percentile = config['stratz'].get('hedge_percentile')
+    stratz_client.rate_limiter.reconfigure(config['stratz']['requests_per_second'])
+
+
+async def generate(config, stratz_client, cache, refresh=False, deadline=None, snapshot=None, export_snapshot=None):
+    """
+    With a `snapshot`, data comes from it, and `stratz_client` may be None. With `export_snapshot`, all the data
+    is also written as a snapshot to that path.
+    """
+
+    if snapshot is None:
+        configure_stratz_client(stratz_client, config)
+
+    query_planner = create_query_planner(config, cache, snapshot)
+    hero_grids, steam_users, steam_users_by_account_name = plan_grids(config, query_planner)
+
+    hero_grids_writer = HeroGridsWriter()
+    hero_grids_writer.expect(hero_grids, steam_users, config['steam'].get('compact', False))
+    hero_grids_writer.load()
+
+    try:
+        with tracer.span('phase.grids'):
+            _, updated_hero_grids = await asyncio.gather(
+                query_planner.execute(stratz_client, refresh, deadline),
+                output_grids(hero_grids, steam_users_by_account_name, hero_grids_writer)
+            )
+    finally:
+        await hero_grids_writer.close()
+
+    if export_snapshot is not None:
+        save_snapshot(query_planner, export_snapshot)
+
+    print('\n{} updated for {}!\n'.format(plural(len(updated_hero_grids), 'grid'), plural(len(steam_users_by_account_name), 'user')))
+
+
+def save_snapshot(query_planner, path):
+    with tracer.span('snapshot.save'):
+        snapshot = StratzSnapshot.from_planner(query_planner)
+        snapshot.save(path)
+
+    print('Snapshot of {} written to {}.'.format(plural(len(snapshot.results), 'query result'), path))
+
+
+def create_cache(config, args):
+    cache_config = config.get('cache', {})
+    return StratzCache(
+        cache_config.get('path', 'cache'),
+        cache_config.get('ttl', 6 * 60 * 60),
+        cache_config.get('max_size', 100),
+        args.offline
+    )
+
+
+def create_deadline(config, args):
+    """
+    The run's deadline as a `time.monotonic()` timestamp, or None if there isn't one.
+    """
+
+    seconds = args.deadline if args.deadline is not None else config['stratz'].get('deadline')
+    if seconds is None:
+        return None
+
+    return time.monotonic() + seconds
+
+
+def next_stratz_week(timestamp):
+    """
+    Start of the Stratz week following `timestamp`. Weeks start on Monday, 00:00 UTC.
+    """
+
+    monday = 4 * 24 * 60 * 60 # The epoch was a Thursday.
+    return (timestamp - monday) // STRATZ_WEEK * STRATZ_WEEK + monday + STRATZ_WEEK
+
+
+async def run_daemon(args, stratz_client, run=generate):
+    """
+    Keeps regenerating grids with the same HTTP session: right away whenever the config file changes,
+    and with fresh data from Stratz on a schedule. Only categories whose options or data changed are rebuilt,
+    and only grid files whose content changed are written.
+
+    `run` is what regenerating means; by default it's writing the grids for the users in the config.
+    """
+
+    config = None
+    config_mtime = None
+    next_refresh = 0
+    runs = 0
+
+    while True:
+        try:
+            mtime = os.stat(args.config).st_mtime_ns
+        except OSError:
+            mtime = config_mtime
+
+        config_changed = mtime != config_mtime
+        if config_changed:
+            config_mtime = mtime
             try:
-                hero_grids_configs_by_user_account_name[user].add(grid)
-            except KeyError:
-                pass
+                config = load_config(args.config)
+            except Error as e:
+                print('Error: {}\n'.format(e.args[0]))
 
-    for hero_grids_config in hero_grids_configs:
-        hero_grids_config.save()
+        now = time.time()
+        refresh_due = now >= next_refresh
+        daemon_config = config.get('daemon', {}) if config is not None else {}
 
-    for grid in grids:
-        users = ['{} ({})'.format(user, steam_users_by_account_name[user].persona_name) for user in grid.users]
-        print('{} updated for {}.'.format(grid.name, ', '.join(users)))
+        if config is not None and (config_changed or refresh_due):
+            if refresh_due:
+                next_refresh = now + daemon_config.get('refresh_interval', 24 * 60 * 60)
+                if daemon_config.get('align_to_weekly_rollover', True):
+                    next_refresh = min(next_refresh, next_stratz_week(now) + STRATZ_WEEK_ROLLOVER_DELAY)
+
+            try:
+                await run(config, stratz_client, create_cache(config, args), refresh_due and runs > 0, create_deadline(config, args))
+            except Error as e:
+                print('Error: {}\n'.format(e.args[0]))
+            except (KeyError, TypeError, ValueError) as e:
+                # The config is edited by hand while this keeps running, so a broken edit mustn't bring it down.
+                print('Error: {}\n'.format(invalid_config_error(args.config, e).args[0]))
+
+            runs += 1
+            print('Next refresh at {}. Watching {} for changes.\n'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(next_refresh)), args.config))
 
-    print('\n{} grid{} updated for {} user{}!\n'.format(len(grids), 's' if len(grids) > 1 else '', len(steam_users), 's' if len(steam_users) > 1 else ''))
+        await asyncio.sleep(daemon_config.get('poll_interval', DAEMON_POLL_INTERVAL))
+
+
+async def build_grids(config, stratz_client, cache, refresh=False, deadline=None, log=print):
+    """
+    Builds the grids in the config without writing them anywhere. Returns the grids that were built.
+    """
+
+    configure_stratz_client(stratz_client, config)
+
+    query_planner = create_query_planner(config, cache)
+    hero_grids = create_hero_grids(config, query_planner, log)
+
+    async def build(hero_grid):
+        try:
+            await hero_grid.build()
+        except TimedOut as e:
+            log('Warning: {} wasn\'t updated. {}'.format(hero_grid.name, e.args[0]))
+            return None
+
+        report_incomplete_data(hero_grid, log)
+        return hero_grid
+
+    with tracer.span('phase.grids'):
+        _, built_hero_grids = await asyncio.gather(
+            query_planner.execute(stratz_client, refresh, deadline),
+            asyncio.gather(*[build(hero_grid) for hero_grid in hero_grids])
+        )
+
+    return [hero_grid for hero_grid in built_hero_grids if hero_grid is not None]
+
+
+class HeroGridServer:
+    """
+    Serves built grids over HTTP, in the format of the grid config files: `/grids` has all of them, and
+    `/users/<account name>` those of a single user. Every response carries an ETag, so that clients can check for
+    updates with cheap conditional GETs.
+    """
+
+    def __init__(self):
+        self.grids = {}
+        self.documents = {}
+
+    async def generate(self, config, stratz_client, cache, refresh=False, deadline=None):
+        """
+        Rebuilds the grids and swaps in the new documents. Grids that couldn't be built keep being served as they were.
+        """
+
+        hero_grids = await build_grids(config, stratz_client, cache, refresh, deadline)
+
+        names = {grid['name'] for grid in expand_grids(config)}
+        self.grids = {name: grid for name, grid in self.grids.items() if name in names}
+        for hero_grid in hero_grids:
+            self.grids[hero_grid.name] = (hero_grid.users, hero_grid.serialize(True))
+
+        users = sorted({user for grid_users, _ in self.grids.values() for user in grid_users})
+        documents = {'/grids': self.document(self.grids.values())}
+        for user in users:
+            documents[f'/users/{user}'] = self.document(grid for grid in self.grids.values() if user in grid[0])
+
+        self.documents = documents
+        print('Serving {} for {}.\n'.format(plural(len(self.grids), 'grid'), plural(len(users), 'user')))
+
+    @staticmethod
+    def document(grids):
+        body = '{{"version":3,"configs":[{}]}}'.format(','.join(serialized for _, serialized in grids)).encode('utf-8')
+        return '"{}"'.format(hashlib.sha256(body).hexdigest()), body
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        tracer.count('server.requests')
+        if request.path not in self.documents:
+            raise web.HTTPNotFound()
+
+        etag, body = self.documents[request.path]
+        if_none_match = request.headers.get('If-None-Match', '')
+        if if_none_match == '*' or etag in (tag.strip() for tag in if_none_match.split(',')):
+            tracer.count('server.not_modified')
+            return web.Response(status=304, headers={'ETag': etag})
+
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def start(self, host, port):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/grids', self.handle)
+        app.router.add_get('/users/{user}', self.handle)
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+async def run_server(args, stratz_client, config):
+    serve_config = config.get('serve', {})
+    host = serve_config.get('host', '127.0.0.1')
+    port = serve_config.get('port', 8766)
+
+    server = HeroGridServer()
+    runner = await server.start(host, port)
+    print('Serving grids at http://{}:{}/grids.\n'.format(host, port))
+
+    try:
+        await run_daemon(args, stratz_client, server.generate)
+    finally:
+        await runner.cleanup()
+
+
+async def pull(url, config, http_session, etags):
+    """
+    Pulls the grids of every local Steam user from a generator running with --serve, and writes those that changed.
+    The ETags of what was last pulled are kept in `etags`, so that pulling again only costs conditional GETs.
+    """
+
+    import aiohttp
+    import urllib.parse
+
+    compact = config['steam'].get('compact', False)
+    for steam_path in get_steam_paths(config):
+        for user in load_steam_users(steam_path):
+            key = (steam_path, user.id3)
+            headers = {'If-None-Match': etags[key]} if key in etags else {}
+            try:
+                async with http_session.get('{}/users/{}'.format(url.rstrip('/'), urllib.parse.quote(user.account_name)), headers=headers) as resp:
+                    if resp.status in (304, 404):
+                        continue
+
+                    if resp.status != 200:
+                        raise Error(f'The grid server at {url} responded with {resp.status}.')
+
+                    data = json_loads(await resp.read())
+                    etag = resp.headers.get('ETag')
+            except aiohttp.ClientError:
+                raise Error(f'Couldn\'t reach the grid server at {url}.')
+
+            hero_grids = [PulledHeroGrid(grid) for grid in data['configs']]
+            hero_grids_config = HeroGridsConfig(steam_path, user, compact)
+            for hero_grid in hero_grids:
+                hero_grids_config.add(hero_grid)
+
+            saved = hero_grids_config.save()
+            if etag is not None:
+                etags[key] = etag
+
+            if saved:
+                print('{} pulled for {} ({}).'.format(', '.join(hero_grid.name for hero_grid in hero_grids), user.account_name, user.persona_name))
+
+
+async def run_pull(args, config):
+    """
+    Pulls once, or with --daemon, keeps pulling every `serve.pull_interval` seconds.
+    """
+
+    import aiohttp
+
+    etags = {}
+    async with aiohttp.ClientSession() as http_session:
+        while True:
+            try:
+                await pull(args.pull, config, http_session, etags)
+            except Error as e:
+                if not args.daemon:
+                    raise
+
+                print('Error: {}\n'.format(e.args[0]))
+
+            if not args.daemon:
+                break
+
+            await asyncio.sleep(config.get('serve', {}).get('pull_interval', 60))
+
+
+def find_config_paths(paths):
+    """
+    Expands directories into the JSON files directly inside them.
+    """
+
+    config_paths = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            config_paths.extend(sorted(path.glob('*.json')))
+        else:
+            config_paths.append(path)
+
+    if not config_paths:
+        raise Error('No config files found in {}.'.format(', '.join(paths)))
+
+    return config_paths
+
+
+async def run_batch(args, stratz_client, configs, snapshot=None):
+    """
+    Generates grids for many configs at once, with one HTTP session, one rate limiter and one query planner,
+    so that queries shared between configs are only fetched once. The Stratz and cache settings of the first
+    config are used for the whole batch, except for the rate, which is the lowest of them all.
+    Errors are reported per config, and don't stop the other configs.
+    """
+
+    first_config = next(iter(configs.values()))
+    query_planner = create_query_planner(first_config, create_cache(first_config, args), snapshot)
+
+    def logger(path):
+        return lambda message: print('{}: {}'.format(path, message))
+
+    # Every config registers its queries and grids before anything is executed, so that shared queries are fetched
+    # once, and a user's file that several configs write to is read and saved once.
+    hero_grids_writer = HeroGridsWriter()
+    results = {}
+    plans = {}
+    for path, config in configs.items():
+        try:
+            plans[path] = plan_grids(config, query_planner, logger(path))
+        except Error as e:
+            results[path] = e
+        except (KeyError, TypeError, ValueError) as e:
+            results[path] = invalid_config_error(path, e)
+        else:
+            hero_grids_writer.expect(plans[path][0], plans[path][1], config['steam'].get('compact', False))
+
+    # Only the configs that are going to run have a say in how Stratz is queried.
+    if snapshot is None and plans:
+        planned_paths = list(plans)
+        configure_stratz_client(stratz_client, configs[planned_paths[0]])
+        stratz_client.rate_limiter.reconfigure(min(configs[path]['stratz']['requests_per_second'] for path in planned_paths))
+
+        if any(configs[path]['stratz']['token'] != stratz_client.token for path in planned_paths):
+            print('Warning: The configs use different Stratz tokens, only the one from {} is used.\n'.format(planned_paths[0]))
+
+    hero_grids_writer.load()
+
+    async def run(path, hero_grids, steam_users, steam_users_by_account_name):
+        with tracer.span('batch.config', config=str(path)):
+            return await output_grids(hero_grids, steam_users_by_account_name, hero_grids_writer, logger(path))
+
+    try:
+        with tracer.span('phase.grids'):
+            execution, *outputs = await asyncio.gather(
+                query_planner.execute(stratz_client, deadline=None if snapshot is not None else create_deadline(first_config, args)),
+                *[run(path, *plan) for path, plan in plans.items()],
+                return_exceptions=True
+            )
+    finally:
+        await hero_grids_writer.close()
+
+    if isinstance(execution, BaseException):
+        raise execution
+
+    if args.export_snapshot is not None:
+        save_snapshot(query_planner, args.export_snapshot)
+
+    for path, output in zip(plans, outputs):
+        if isinstance(output, BaseException) and not isinstance(output, Error):
+            raise output
+
+        results[path] = output
+
+    print()
+    for path in configs:
+        if isinstance(results[path], Error):
+            print('{}: Error: {}'.format(path, results[path].args[0]))
+        else:
+            _, _, steam_users_by_account_name = plans[path]
+            print('{}: {} updated for {}.'.format(path, plural(len(results[path]), 'grid'), plural(len(steam_users_by_account_name), 'user')))
+
+    print()
+
+
+async def main(args):
+    if args.pull:
+        await run_pull(args, load_config(args.config))
+        return
+
+    if args.batch:
+        configs = {}
+        for path in find_config_paths(args.batch):
+            try:
+                config = load_config(path)
+                check_config(path, config, args.snapshot is None)
+                configs[path] = config
+            except Error as e:
+                print('{}: Error: {}'.format(path, e.args[0]))
+
+        if not configs:
+            raise Error('None of the config files could be loaded.')
+
+        config = next(iter(configs.values()))
+    else:
+        config = load_config(args.config)
+
+    if args.snapshot:
+        # Everything comes from the snapshot, so no token is needed and Stratz is never contacted.
+        snapshot = StratzSnapshot.load(args.snapshot)
+        if args.batch:
+            await run_batch(args, None, configs, snapshot)
+        else:
+            await generate(config, None, create_cache(config, args), snapshot=snapshot, export_snapshot=args.export_snapshot)
+
+        return
+
+    stratz_client = StratzClient(
+        config['stratz']['token'],
+        config['stratz']['requests_per_second'],
+        api_url=config['stratz'].get('api_url', StratzClient.API_URL)
+    )
+
+    try:
+        if args.batch:
+            await run_batch(args, stratz_client, configs)
+        elif args.serve:
+            await run_server(args, stratz_client, config)
+        elif args.daemon:
+            await run_daemon(args, stratz_client)
+        else:
+            await generate(config, stratz_client, create_cache(config, args), deadline=create_deadline(config, args), export_snapshot=args.export_snapshot)
+    finally:
+        await stratz_client.close()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates Dota 2 hero grids from Stratz data.')
+    parser.add_argument('--config', default='config.json', help='path to the config file (default: config.json)')
+    parser.add_argument('--offline', '--cache-only', action='store_true', help='only use cached Stratz data, never touch the network')
+    parser.add_argument('--daemon', action='store_true', help='keep running, regenerating grids on a schedule and whenever the config file changes')
+    parser.add_argument('--deadline', type=float, metavar='SECONDS', help='stop waiting on Stratz after this many seconds, and write whatever is ready (overrides stratz.deadline)')
+    parser.add_argument('--batch', nargs='+', metavar='PATH', help='generate grids for many config files (or directories of them) at once, sharing Stratz requests between them')
+    parser.add_argument('--serve', action='store_true', help='keep running like with --daemon, but serve the grids over HTTP instead of writing them (see serve in the config)')
+    parser.add_argument('--pull', metavar='URL', help='write the grids served by another instance running with --serve at URL, instead of generating them; keeps pulling with --daemon')
+    parser.add_argument('--export-snapshot', metavar='FILE', help='also write all the data fetched for the grids to FILE, to generate them elsewhere with --snapshot')
+    parser.add_argument('--snapshot', metavar='FILE', help='generate the grids from a snapshot written with --export-snapshot, without a Stratz token or network access')
+    parser.add_argument('--trace', metavar='FILE', help='write timings of every request, category and phase, and counters, as JSON to FILE')
+    parser.add_argument('--profile', metavar='FILE', help='run under cProfile and write the stats to FILE (view with `python -m pstats FILE`)')
+    args = parser.parse_args()
+
+    if args.batch and (args.daemon or args.serve or args.pull):
+        parser.error('--batch can\'t be used with --daemon, --serve or --pull')
+
+    if args.serve and args.pull:
+        parser.error('--serve and --pull can\'t be used together')
+
+    if (args.snapshot or args.export_snapshot) and (args.daemon or args.serve or args.pull):
+        parser.error('--snapshot and --export-snapshot can\'t be used with --daemon, --serve or --pull')
+
+    tracer.enabled = args.trace is not None
+
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     try:
-        asyncio.run(main())
-    except aiohttp.ClientError:
-        raise Error('Something happened with the network. Maybe Stratz is unavailable or your internet is down.')
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
     except Error as e:
         print('Error: {}\n'.format(e.args[0]))
     finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+        if args.trace:
+            tracer.dump(args.trace)
+
         if getattr(sys, "frozen", False):
             input()
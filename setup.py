@@ -1,8 +1,9 @@
 from cx_Freeze import setup
 
+# aiohttp and vdf are only imported inside functions, so they're listed explicitly.
 build_exe_options = {
     'include_files': ['config.json'],
-    'packages': ['multiprocessing']
+    'packages': ['aiohttp', 'vdf']
 }
 
 setup(